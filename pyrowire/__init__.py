@@ -1,6 +1,7 @@
 __author__ = 'keith.hamilton'
 from pyrowire import configure
 from decorators.decorators import handler, validator
-from messaging.send import sms, mms
+from messaging.send import sms, mms, async_sms, async_mms
 from messaging.message import message_from_request
 from runner.runner import run
+from messaging.broadcast import broadcast
@@ -1,7 +1,82 @@
+from collections import OrderedDict
 import os
 
 PYROWIRE = None
 
+# defaults for the optional connection pool keys of a profile's redis block
+REDIS_POOL_DEFAULTS = {
+    'max_connections': 50,
+    'socket_timeout': None,
+    'socket_connect_timeout': None
+}
+
+# defaults for the optional dedupe block of a topic, which controls how retried twilio webhooks are recognized
+DEDUPE_DEFAULTS = {
+    'ttl': 3600,
+    'local_cache': 1000
+}
+
+# defaults for the optional backpressure block of a topic, which caps how far its queue may grow
+BACKPRESSURE_DEFAULTS = {
+    'max_queue_depth': None,
+    'response': None
+}
+
+# defaults for the optional queue block of a topic, which picks the backend its messages are queued on
+QUEUE_DEFAULTS = {
+    'backend': 'list',
+    'claim_after': 60
+}
+
+# defaults for the optional retention block of a topic, which bounds its complete and error history
+RETENTION_DEFAULTS = {
+    'max_entries': None,
+    'max_age': None,
+    'interval': 300,
+    'chunk': 500
+}
+
+# defaults for the optional error_log block of a topic, which caps its error log
+ERROR_LOG_DEFAULTS = {
+    'max_length': 10000
+}
+
+# defaults for the optional autoscale block of a topic, which lets the runner size the topic's worker pool to its
+# backlog
+AUTOSCALE_DEFAULTS = {
+    'min_workers': 1,
+    'max_workers': 8,
+    'scale_up_backlog': 10,
+    'scale_down_backlog': 1,
+    'interval': 5,
+    'cooldown': 60
+}
+
+# defaults for the optional connection and rate keys of a topic's twilio block, used by the outbound messages client
+TWILIO_DEFAULTS = {
+    'base_url': 'https://api.twilio.com',
+    'timeout': 10,
+    'connections': 4,
+    'rate': None,
+    'burst': 1,
+    'max_pending': 1000
+}
+
+# defaults for the optional outbound block of a topic, which hands its outbound messages to sender workers
+OUTBOUND_DEFAULTS = {
+    'queue': False,
+    'concurrency': 16,
+    'max_attempts': 5
+}
+
+# defaults for the optional replies block of a profile, which sizes the outbound reply executor
+REPLY_DEFAULTS = {
+    'workers': 4,
+    'max_queue': 1000,
+    'overflow': 'drop',
+    'block_timeout': 1
+}
+
 def configure(settings, flask):
     """
     sets up the global PYROWIRE object, containing all of the settings needed to run pyrowire.
@@ -13,8 +88,11 @@ def configure(settings, flask):
         'profile': settings.PROFILES[os.environ['ENV'].lower()],
         'topics': settings.TOPICS,
         'app': flask,
-        'validators': {}
+        'validators': OrderedDict(),
+        'validator_chains': {},
+        'redis_connection': None
     }
+    build_validator_chains()
 # Utility - Application getters
 #-----------------------------------------------------------------------------------------------------------------------
 def topics(topic=None):
@@ -27,6 +105,9 @@ def validators(topic=None):
         return PYROWIRE['topics'][topic]['validators']
     return PYROWIRE['validators']
 
+def validator_chain(topic=None):
+    return PYROWIRE['validator_chains'][topic]
+
 def properties(topic=None, key=None):
     if key:
         return PYROWIRE['topics'][topic]['properties'][key]
@@ -35,6 +116,9 @@ def properties(topic=None, key=None):
 def twilio(topic=None):
     return PYROWIRE['topics'][topic]['twilio']
 
+def twilio_option(topic=None, key=None):
+    return PYROWIRE['topics'][topic]['twilio'].get(key, TWILIO_DEFAULTS[key])
+
 def handler(topic=None):
     if 'handler' in PYROWIRE['topics'][topic].keys():
         return PYROWIRE['topics'][topic]['handler']
@@ -42,6 +126,41 @@ def handler(topic=None):
 def max_message_length(topic=None):
     return PYROWIRE['topics'][topic]['max_message_length']
 
+def batch_size(topic=None):
+    return PYROWIRE['topics'][topic].get('batch_size', 1)
+
+def concurrency(topic=None):
+    return PYROWIRE['topics'][topic].get('concurrency', 1)
+
+def workers(topic=None):
+    return PYROWIRE['topics'][topic].get('workers', 1)
+
+def queue(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('queue', {}).get(key, QUEUE_DEFAULTS[key])
+
+def retention(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('retention', {}).get(key, RETENTION_DEFAULTS[key])
+
+def retained(topic=None):
+    return bool(retention(topic, 'max_entries') or retention(topic, 'max_age'))
+
+def error_log(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('error_log', {}).get(key, ERROR_LOG_DEFAULTS[key])
+
+def weight(topic=None):
+    return PYROWIRE['topics'][topic].get('weight', 1)
+
+def shared(topic=None):
+    return PYROWIRE['topics'][topic].get('shared', False)
+
+def autoscale(topic=None, key=None):
+    if 'autoscale' not in PYROWIRE['topics'][topic]:
+        return None
+    return PYROWIRE['topics'][topic]['autoscale'].get(key, AUTOSCALE_DEFAULTS[key])
+
+def outbound(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('outbound', {}).get(key, OUTBOUND_DEFAULTS[key])
+
 def send_on_accept(topic=None):
     return PYROWIRE['topics'][topic]['send_on_accept']
 
@@ -51,14 +170,41 @@ def accept_response(topic=None):
 def error_response(topic=None):
     return PYROWIRE['topics'][topic]['error_response']
 
+def dedupe(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('dedupe', {}).get(key, DEDUPE_DEFAULTS[key])
+
+def rate_limit(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('rate_limit', {}).get(key)
+
+def backpressure(topic=None, key=None):
+    return PYROWIRE['topics'][topic].get('backpressure', {}).get(key, BACKPRESSURE_DEFAULTS[key])
+
+def parseable_characters(topic=None):
+    return PYROWIRE['topics'][topic].get('parseable_characters', u'')
+
 # Utility - app setter
 # ----------------------------------------------------------------------------------------------------------------------
 def add_validator(validator=None):
     PYROWIRE['validators'][validator.__name__] = validator
+    build_validator_chains()
 
 def add_handler(topic=None, handler=None):
     PYROWIRE['topics'][topic]['handler'] = handler
 
+def build_validator_chains():
+    """
+    compiles, for each topic, the ordered tuple of (validator, error_response) pairs that inbound messages for that
+    topic are run through, so the ingest route does not have to match registered validators to topic settings per
+    request. called whenever the topics are configured or a validator is added.
+    """
+    PYROWIRE['validator_chains'] = dict(
+        (topic, tuple((func, settings['validators'][name]) for name, func in PYROWIRE['validators'].items()
+                      if name in settings['validators']))
+        for topic, settings in PYROWIRE['topics'].items())
+
+def set_redis_connection(connection=None):
+    PYROWIRE['redis_connection'] = connection
+
 # Utility - Profile getters
 # ----------------------------------------------------------------------------------------------------------------------
 def debug():
@@ -78,8 +224,20 @@ def redis(key=None):
         return PYROWIRE['profile']['redis'][key]
     return PYROWIRE['profile']['redis']
 
+def redis_pool_option(key=None):
+    return PYROWIRE['profile']['redis'].get(key, REDIS_POOL_DEFAULTS[key])
+
+def replies(key=None):
+    return PYROWIRE['profile'].get('replies', {}).get(key, REPLY_DEFAULTS[key])
+
+def worker_threads():
+    return PYROWIRE['profile'].get('worker_threads', 32)
+
 # Utility - global getter
 # ----------------------------------------------------------------------------------------------------------------------
 def app():
     return PYROWIRE['app']
 
+def redis_connection():
+    return PYROWIRE['redis_connection']
+
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import sys
+import time
+import traceback
+
+import pyrowire.config.configuration as config
+
+# Error log
+# ----------------------------------------------------------------------------------------------------------------------
+# each topic's errors are appended to the <topic>.errors stream, capped at about the topic's error_log max_length
+# entries. every entry is a json record of the error, under 'record', with its class and signature alongside so they
+# can be read without parsing it. how often each signature has occurred is counted in the <topic>.error.counts hash.
+def error_record(error=None, message=None, source=None):
+    """
+    builds the record of an error; call from the except block that caught it, so its traceback is at hand
+    :param error: the exception
+    :param message: the message data being handled when it was raised
+    :param source: where it was raised, e.g. 'ingest' or 'worker'
+    :return: dict, the error record
+    """
+    exc_type, exc_value, tb = sys.exc_info()
+    if exc_value is not error:
+        exc_type, tb = type(error), None
+    frames = traceback.extract_tb(tb) if tb else []
+    # the same failure, from the same place, gets the same signature, whatever the message was
+    where = '|'.join('%s:%s:%s' % (filename, line, function) for filename, line, function, text in frames)
+    return {
+        'time': time.time(),
+        'source': source,
+        'class': exc_type.__name__,
+        'error': str(error),
+        'signature': hashlib.sha1('%s|%s' % (exc_type.__name__, where)).hexdigest()[:12],
+        'traceback': ''.join(traceback.format_exception(exc_type, error, tb)) if tb else None,
+        'message': message
+    }
+
+def log_error(topic=None, record=None, redis=None):
+    """
+    appends an error record to the topic's error log, and counts it. if redis is a pipeline, the commands are only
+    added to it.
+    :param topic: the topic the error occurred for
+    :param record: an error record, as built by error_record()
+    :param redis: the redis client or pipeline to use
+    """
+    redis.xadd('%s.%s' % (topic, 'errors'),
+               {'class': record['class'], 'signature': record['signature'],
+                'record': json.dumps(record, default=repr)},
+               maxlen=config.error_log(topic, 'max_length'), approximate=True)
+    redis.hincrby('%s.%s' % (topic, 'error.counts'), '%s:%s' % (record['class'], record['signature']), 1)
+    redis.hincrby('%s.%s' % (topic, 'metrics'), 'errors', 1)
+
+def recent_errors(topic=None, count=10, redis=None):
+    """
+    :param topic: the topic
+    :param count: the most records to return
+    :param redis: the redis client to use
+    :return: list of the topic's latest error records, newest first, each with its stream entry id under 'id'
+    """
+    records = []
+    for entry_id, fields in redis.xrevrange('%s.%s' % (topic, 'errors'), count=count):
+        record = json.loads(fields['record'])
+        record['id'] = entry_id
+        records.append(record)
+    return records
+
+def error_counts(topic=None, redis=None):
+    """
+    :param topic: the topic
+    :param redis: the redis client to use
+    :return: dict of 'class:signature' to the number of times that error has occurred
+    """
+    return dict((key, int(count)) for key, count in redis.hgetall('%s.%s' % (topic, 'error.counts')).items())
@@ -0,0 +1,67 @@
+import time
+
+import pyrowire.config.configuration as config
+
+# lua function that takes one token from each of the given buckets, or from none of them. args holds a (rate, burst)
+# pair per bucket starting at index first, where rate is tokens added per second and burst is the bucket size.
+# returns 0 if the tokens were taken, or the number of milliseconds until the emptiest bucket has a token again.
+# scripts that need to rate limit start with this source.
+TOKEN_BUCKET_LUA = """
+local function take_token(keys, args, first, now)
+    local levels = {}
+    for i, key in ipairs(keys) do
+        local rate, burst = tonumber(args[first + i * 2 - 2]), tonumber(args[first + i * 2 - 1])
+        local bucket = redis.call('HMGET', key, 'tokens', 'time')
+        local level = tonumber(bucket[1]) or burst
+        local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+        level = math.min(burst, level + elapsed * rate)
+        if level < 1 then
+            return math.ceil((1 - level) / rate * 1000)
+        end
+        levels[i] = level
+    end
+    for i, key in ipairs(keys) do
+        local rate, burst = tonumber(args[first + i * 2 - 2]), tonumber(args[first + i * 2 - 1])
+        redis.call('HMSET', key, 'tokens', levels[i] - 1, 'time', now)
+        redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+    end
+    return 0
+end
+"""
+
+# takes a token from each of the buckets in KEYS; ARGV holds the current time in seconds, then the (rate, burst) pairs
+TOKEN_BUCKET_SCRIPT = TOKEN_BUCKET_LUA + """
+return take_token(KEYS, ARGV, 2, tonumber(ARGV[1]))
+"""
+
+# lazily registered scripts, shared by every client of the process's connection pool
+SCRIPTS = {}
+
+# Token buckets
+# ----------------------------------------------------------------------------------------------------------------------
+def take_token(buckets, redis=None):
+    """
+    takes a token from each of the given token buckets in a single atomic round trip to redis. if any of the buckets is
+    empty, no tokens are taken.
+    :param buckets: list of (key, rate, burst) tuples; rate is tokens added per second, burst is the bucket size
+    :param redis: the redis client to use, defaults to the process's shared client
+    :return: int, 0 if a token was taken, otherwise milliseconds until one can be
+    """
+    if not buckets:
+        return 0
+    redis = redis or config.redis_connection()
+    args = [repr(time.time())]
+    for key, rate, burst in buckets:
+        args.extend([rate, burst])
+    return script('token_bucket', TOKEN_BUCKET_SCRIPT)(keys=[b[0] for b in buckets], args=args, client=redis)
+
+def script(name, source):
+    """
+    returns a registered lua script, which is run with EVALSHA and loaded into redis on first use
+    :param name: name to cache the script under
+    :param source: the lua source of the script
+    :return: redis.client.Script, the registered script
+    """
+    if name not in SCRIPTS:
+        SCRIPTS[name] = config.redis_connection().register_script(source)
+    return SCRIPTS[name]
@@ -0,0 +1,95 @@
+from itertools import islice
+import logging
+import uuid
+
+import pyrowire.config.configuration as config
+from pyrowire.messaging.client import TwilioError, client, delivery
+
+# numbers read from the recipients, and checked against the results already recorded, per round trip
+CHUNK = 500
+# seconds a broadcast's results are kept after its last message was sent, unless the topic's retention max_age is set
+RESULTS_TTL = 7 * 24 * 3600
+
+# Broadcast
+# ----------------------------------------------------------------------------------------------------------------------
+# the result for each recipient of a broadcast is kept in the <topic>.broadcast.<id> hash, under the recipient's number:
+#   - the twilio sid of the message, if it was sent
+#   - 'failed:<twilio error code>', if twilio turned it down
+#   - 'unknown:<exception class>', if twilio may have created it before it failed, e.g. if its response timed out
+#   - 'error:<exception class>', if twilio cannot have created it, e.g. because twilio could not be reached, or was busy
+# numbers with an error are sent again when a broadcast is resumed; all others are skipped, so that no number is sent
+# the message twice. the hash expires RESULTS_TTL seconds, or the topic's retention max_age, after its last result.
+def broadcast(topic=None, numbers=None, body=None, media_url=None, broadcast_id=None):
+    """
+    sends one message to many numbers, a chunk at a time. each chunk's messages are submitted to the topic's messages
+    client all at once, and sent on its keep-alive connections, shaped to its from number's rate, if it has one. each
+    recipient's result is recorded as soon as its message is sent, so a broadcast that was cut short, e.g. by a crash,
+    can be resumed by calling broadcast again with its id; only numbers whose message twilio cannot have created are
+    sent it again.
+    :param topic: the topic whose twilio account and from number to send from
+    :param numbers: an iterable of the numbers to send to, or the key of a redis set of them
+    :param body: the text of the message, if any
+    :param media_url: the url of the media to send, if any
+    :param broadcast_id: the id of the broadcast to resume, or None to start a new one
+    :return: dict, the broadcast's id, and the numbers of messages sent, failed, and skipped by this call
+    :raise e: TypeError if there is neither a body nor a media url
+    """
+    if body is None and not media_url:
+        raise TypeError('a broadcast must have a body or a media_url')
+
+    redis = config.redis_connection()
+    broadcast_id = broadcast_id or uuid.uuid4().hex
+    results = '%s.%s.%s' % (topic, 'broadcast', broadcast_id)
+    if isinstance(numbers, basestring):
+        numbers = redis.sscan_iter(numbers, count=CHUNK)
+    numbers = iter(numbers)
+    counts = {'id': broadcast_id, 'sent': 0, 'failed': 0, 'skipped': 0}
+    messages_client = client(topic)
+
+    while True:
+        # a set may be scanned out of order, and repeat numbers; repeats within a chunk are sent once
+        chunk = list(set(islice(numbers, CHUNK)))
+        if not chunk:
+            break
+        recorded = redis.hmget(results, chunk)
+        pending = [number for number, result in zip(chunk, recorded) if result is None or result.startswith('error:')]
+        counts['skipped'] += len(chunk) - len(pending)
+        # each result is recorded as soon as its message is sent, from the client's sender thread
+        futures = [messages_client.submit(to=number, body=body, media_url=media_url,
+                                          callback=lambda future, number=number: record(topic, results, number, future),
+                                          block=True)
+                   for number in pending]
+        for future in futures:
+            counts[outcome(future)[1]] += 1
+    return counts
+
+def outcome(future=None):
+    """
+    waits for a broadcast's message to one number to be sent
+    :param future: the message's future
+    :return: tuple of (result to record, 'sent' or 'failed')
+    """
+    error = future.exception()
+    if error is None:
+        return future.result().get('sid') or 'sent', 'sent'
+    kind = delivery(error)
+    if kind == 'failed' and isinstance(error, TwilioError):
+        return 'failed:%s' % (error.code or error.status), 'failed'
+    return '%s:%s' % (kind, type(error).__name__), 'failed'
+
+def record(topic=None, results=None, number=None, future=None):
+    """
+    records the result of a broadcast's message to one number
+    :param topic: the topic sent from
+    :param results: the key of the broadcast's results hash
+    :param number: the number sent to
+    :param future: the message's future, once it is done
+    """
+    result, status = outcome(future)
+    if status == 'failed' and not result.startswith('failed:'):
+        logging.getLogger(__name__).error(future.exception())
+    pipeline = config.redis_connection().pipeline(transaction=False)
+    pipeline.hset(results, number, result)
+    pipeline.expire(results, config.retention(topic, 'max_age') or RESULTS_TTL)
+    pipeline.hincrby('%s.%s' % (topic, 'metrics'), 'sent' if status == 'sent' else 'send_failed', 1)
+    pipeline.execute()
@@ -0,0 +1,431 @@
+import base64
+import httplib
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from Queue import Queue, Empty, Full
+
+import pyrowire.config.configuration as config
+from pyrowire.limits.limits import take_token
+
+# path of the twilio messages resource, relative to the base url
+MESSAGES_PATH = '/2010-04-01/Accounts/%s/Messages.json'
+
+# per-process cache of messages clients, keyed by (account_sid, from_number), and of the client for each topic;
+# rebuilt lazily in each process (e.g., after a gunicorn fork), so that no two processes share a connection
+CLIENTS = {
+    'pid': None,
+    'clients': {},
+    'topics': {}
+}
+CLIENTS_LOCK = threading.Lock()
+
+class TwilioError(Exception):
+    """
+    raised when the messages api turns a message down
+    """
+
+    def __init__(self, status=None, code=None, message=None):
+        """
+        :param status: the http status of the response
+        :param code: the twilio error code, if there was one
+        :param message: the twilio error message, if there was one
+        """
+        Exception.__init__(self, 'HTTP %s error: %s (code %s)' % (status, message, code))
+        self.status = status
+        self.code = code
+        self.message = message
+
+class StaleConnection(Exception):
+    """
+    raised when a reused connection turns out to have been closed by the api before it could have seen a request
+    """
+
+# Client cache
+# ----------------------------------------------------------------------------------------------------------------------
+def client(topic=None):
+    """
+    returns this process's messages client for a topic's twilio account and from number, creating it on first use.
+    topics that share an account and from number share a client, and its connections.
+    :param topic: the topic to send messages for
+    :return: MessagesClient, the topic's client
+    """
+    if CLIENTS['pid'] != os.getpid():
+        with CLIENTS_LOCK:
+            if CLIENTS['pid'] != os.getpid():
+                CLIENTS['clients'], CLIENTS['topics'] = {}, {}
+                CLIENTS['pid'] = os.getpid()
+    messages_client = CLIENTS['topics'].get(topic)
+    if messages_client is None:
+        with CLIENTS_LOCK:
+            twilio_config = config.twilio(topic)
+            key = (twilio_config['account_sid'], twilio_config['from_number'])
+            messages_client = CLIENTS['clients'].get(key)
+            if messages_client is None:
+                messages_client = MessagesClient(twilio_config['account_sid'],
+                                                 twilio_config['auth_token'],
+                                                 twilio_config['from_number'],
+                                                 base_url=config.twilio_option(topic, 'base_url'),
+                                                 timeout=config.twilio_option(topic, 'timeout'),
+                                                 connections=config.twilio_option(topic, 'connections'),
+                                                 rate=config.twilio_option(topic, 'rate'),
+                                                 burst=config.twilio_option(topic, 'burst'),
+                                                 max_pending=config.twilio_option(topic, 'max_pending'))
+                CLIENTS['clients'][key] = messages_client
+            CLIENTS['topics'][topic] = messages_client
+    return messages_client
+
+# Messages client
+# ----------------------------------------------------------------------------------------------------------------------
+class MessagesClient(object):
+    """
+    creates messages through the twilio messages api on a pool of keep-alive http connections, so that a process pays
+    for a tls handshake once per connection, rather than once per message. the client is thread safe; each thread
+    takes an idle connection from the pool, or opens a new one if none is idle, and hands it back when done.
+    if the from number has a rate, messages are shaped to it with a token bucket in redis, shared by every process
+    sending from the number; a message waits for a token, rather than being sent only to be turned down by twilio.
+    messages may also be submitted without waiting on them, to be created on the client's sender threads, one per
+    connection; each submit returns a MessageFuture at once.
+    """
+
+    def __init__(self, account_sid=None, auth_token=None, from_number=None, base_url=None, timeout=10, connections=4,
+                 rate=None, burst=1, max_pending=1000):
+        """
+        :param account_sid: the twilio account sid
+        :param auth_token: the twilio auth token
+        :param from_number: the number messages are sent from
+        :param base_url: the url of the twilio api
+        :param timeout: seconds to wait on the api before giving up on a message
+        :param connections: the most idle connections to keep open
+        :param rate: the most messages per second to send from the number, or None not to limit them
+        :param burst: the most messages to send from the number at once, after it has been idle
+        :param max_pending: the most submitted messages that may wait for a sender thread
+        """
+        url = urlparse.urlsplit(base_url or config.TWILIO_DEFAULTS['base_url'])
+        self.connection_class = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path.rstrip('/') + MESSAGES_PATH % account_sid
+        self.from_number = from_number
+        self.timeout = timeout
+        self.headers = {
+            'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (account_sid, auth_token)),
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json'
+        }
+        self.idle = Queue(maxsize=connections)
+        self.bucket = ('%s.%s' % ('twilio.rate', from_number), rate, burst) if rate else None
+        self.connections = connections
+        self.pending = Queue(maxsize=max_pending)
+        self.senders = None
+        self.senders_lock = threading.Lock()
+
+    def create(self, to=None, body=None, media_url=None, timeout=None):
+        """
+        creates a message
+        :param to: the number to send the message to
+        :param body: the text of the message, if any
+        :param media_url: the url of the media to send, or a list of them, if any
+        :param timeout: seconds to wait on the api, once the message has waited its turn for the rate limit; defaults
+                        to the client's
+        :return: dict, the message resource created
+        :raise e: TwilioError if the api turned the message down, httplib.HTTPException or socket.error if it could
+                  not be reached, socket.timeout if the api took longer than the timeout
+        """
+        params = [('To', to), ('From', self.from_number)]
+        if body is not None:
+            params.append(('Body', body))
+        for url in ([media_url] if isinstance(media_url, basestring) else media_url or []):
+            params.append(('MediaUrl', url))
+        payload = urllib.urlencode([(name, value.encode('utf-8') if isinstance(value, unicode) else value)
+                                    for name, value in params])
+
+        # the message's timeout starts once it has its token, so a message is never failed for waiting its turn
+        self.shape()
+        status, data = self.post(payload, timeout)
+        try:
+            resource = json.loads(data) if data else {}
+        except ValueError:
+            resource = {}
+        if status >= 400:
+            raise TwilioError(status, resource.get('code'), resource.get('message', data))
+        return resource
+
+    def shape(self):
+        """
+        waits until the from number's token bucket has a token, and takes it
+        :return: float, the seconds waited
+        """
+        waited = 0
+        while self.bucket:
+            wait = take_token([self.bucket])
+            if not wait:
+                break
+            time.sleep(wait / 1000.0)
+            waited += wait / 1000.0
+        return waited
+
+    def post(self, payload=None, timeout=None):
+        """
+        posts a form to the messages resource. a message is never posted twice unless twilio cannot have seen it: a
+        request on a reused connection is only sent again, on a new connection, if the api had closed the connection
+        while it was idle, i.e., if the request could not be sent, or the connection was closed without a response.
+        :param payload: the url encoded form
+        :param timeout: seconds to wait on the api for the response; defaults to the client's
+        :return: tuple of (http status, response body)
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        if timeout <= 0:
+            raise socket.timeout('timed out before the message was sent')
+        connection, reused = self.checkout()
+        try:
+            response, data = self.exchange(connection, payload, timeout, reused)
+        except StaleConnection:
+            connection = self.connect()
+            response, data = self.exchange(connection, payload, timeout)
+        if response.will_close:
+            connection.close()
+        else:
+            self.checkin(connection)
+        return response.status, data
+
+    def exchange(self, connection=None, payload=None, timeout=None, reused=False):
+        """
+        sends a form on a connection, and reads the response; the connection is closed if either fails
+        :param connection: the connection
+        :param payload: the url encoded form
+        :param timeout: seconds to wait on the api for the response
+        :param reused: whether the connection was taken from the pool
+        :return: tuple of (response, response body)
+        :raise e: StaleConnection if the connection was reused, and found closed before the api could have seen the
+                  request; otherwise, whatever error sending or reading raised, with its request_sent attribute set if
+                  the request had been sent in full, so the api may have created the message
+        """
+        sent = False
+        try:
+            connection.timeout = timeout
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request('POST', self.path, payload, self.headers)
+            except socket.error, e:
+                if reused and not isinstance(e, socket.timeout):
+                    raise StaleConnection(e)
+                raise
+            sent = True
+            response = connection.getresponse()
+            return response, response.read()
+        except httplib.BadStatusLine, e:
+            connection.close()
+            # the connection was closed without a byte of response; newer pythons say so in words
+            if reused and (e.line == repr('') or 'closed the connection' in e.line):
+                raise StaleConnection(e)
+            e.request_sent = True
+            raise
+        except BaseException, e:
+            connection.close()
+            e.request_sent = sent
+            raise
+
+    def connect(self):
+        """
+        :return: a new connection to the api
+        """
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def checkout(self):
+        """
+        :return: tuple of (connection, whether it was reused), an idle connection if there is one, or a new one.
+                 idle connections the api has closed are closed, rather than reused
+        """
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                return self.connect(), False
+            if not dropped(connection):
+                return connection, True
+            connection.close()
+
+    def checkin(self, connection=None):
+        """
+        hands a connection back to the pool, or closes it if the pool already has enough idle connections
+        :param connection: the connection
+        """
+        try:
+            self.idle.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    # Submitted messages
+    # ------------------------------------------------------------------------------------------------------------------
+    def submit(self, to=None, body=None, media_url=None, timeout=None, callback=None, block=False):
+        """
+        queues a message to be created on one of the client's sender threads, and returns without waiting on twilio.
+        if max_pending messages are already waiting, waits for room, for up to the message's timeout, or as long as it
+        takes if block is set.
+        :param to: the number to send the message to
+        :param body: the text of the message, if any
+        :param media_url: the url of the media to send, or a list of them, if any
+        :param timeout: seconds to wait on the api, once the message has waited its turn; defaults to the client's
+        :param callback: a function to call with the future once the message has been created, or has failed
+        :param block: whether to wait for room as long as it takes, e.g. for a sender that must not drop messages
+        :return: MessageFuture, the future of the message resource
+        """
+        future = MessageFuture()
+        if callback:
+            future.add_done_callback(callback)
+        timeout = timeout or self.timeout
+        self.start_senders()
+        try:
+            self.pending.put((future, timeout, to, body, media_url), timeout=None if block else timeout)
+        except Full:
+            future.set_exception(socket.timeout('timed out waiting for room to send the message'))
+        return future
+
+    def start_senders(self):
+        """
+        starts the client's sender threads, one per connection, on first use
+        """
+        if self.senders is None:
+            with self.senders_lock:
+                if self.senders is None:
+                    senders = [threading.Thread(target=self.send_pending) for i in range(self.connections)]
+                    for sender in senders:
+                        sender.daemon = True
+                        sender.start()
+                    self.senders = senders
+
+    def send_pending(self):
+        """
+        sender thread loop. creates submitted messages in turn, each waiting its turn for the rate limit, and settles
+        their futures
+        """
+        while True:
+            future, timeout, to, body, media_url = self.pending.get()
+            try:
+                future.set_result(self.create(to, body, media_url, timeout=timeout))
+            except Exception, e:
+                # settled from the except block, so callbacks can record the error's traceback
+                future.set_exception(e)
+
+def delivery(error=None):
+    """
+    tells what the api may have made of a message that failed with an error
+    :param error: the error the message failed with
+    :return: string, 'failed' if the api turned the message down, or it could not be sent at all, e.g. because it had
+             no number; 'unknown' if the api may have created it before the error, e.g. if its response timed out, so it
+             must not be sent again; or 'error' if the api cannot have created it, e.g. because the api could not be
+             reached, or was busy (http 429 or 5xx), so it may be sent again
+    """
+    if isinstance(error, TwilioError):
+        return 'error' if error.status >= 500 or error.status == 429 else 'failed'
+    if getattr(error, 'request_sent', False):
+        return 'unknown'
+    if isinstance(error, (socket.error, httplib.HTTPException)):
+        return 'error'
+    return 'failed'
+
+def dropped(connection=None):
+    """
+    :param connection: an idle connection
+    :return: boolean, whether the api has closed the connection; an idle connection has nothing to read unless it has
+    """
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error):
+        return True
+
+class MessageFuture(object):
+    """
+    the eventual result of a submitted message: the message resource, or the error it failed with. its callbacks are
+    called before anyone waiting on it is woken, so that what they record is in place by then.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.settled = False
+        # the thread calling the future's callbacks, which may look at the future without waiting on itself
+        self.settler = None
+        self.callbacks = []
+        self.value = None
+        self.error = None
+
+    def done(self):
+        """
+        :return: boolean, whether the message has been created, or has failed
+        """
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """
+        waits for the message to be created
+        :param timeout: the most seconds to wait, or None to wait as long as it takes
+        :return: dict, the message resource
+        :raise e: the error the message failed with, or socket.timeout if it is not done within timeout seconds
+        """
+        self.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        """
+        waits for the message to be created, or fail
+        :param timeout: the most seconds to wait, or None to wait as long as it takes
+        :return: the error the message failed with, or None if it was created
+        :raise e: socket.timeout if it is not done within timeout seconds
+        """
+        self.wait(timeout)
+        return self.error
+
+    def wait(self, timeout=None):
+        """
+        waits for the future to be done, and its callbacks to have been called; its callbacks themselves do not wait
+        :param timeout: the most seconds to wait, or None to wait as long as it takes
+        :raise e: socket.timeout if it is not done within timeout seconds
+        """
+        if self.settler != threading.current_thread().ident and not self.event.wait(timeout):
+            raise socket.timeout('timed out waiting on the message')
+
+    def add_done_callback(self, callback=None):
+        """
+        calls a function with the future once it is done, or at once if it already is
+        :param callback: the function
+        """
+        with self.lock:
+            if not self.settled:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, value=None):
+        self.value = value
+        self.settle()
+
+    def set_exception(self, error=None):
+        self.error = error
+        self.settle()
+
+    def settle(self):
+        """
+        calls the future's callbacks, and marks it done
+        """
+        with self.lock:
+            self.settled = True
+            self.settler = threading.current_thread().ident
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.getLogger(__name__).exception('message callback failed')
+        self.event.set()
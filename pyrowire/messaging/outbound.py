@@ -0,0 +1,337 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+import pyrowire.config.configuration as config
+from pyrowire.errors.errors import error_record, log_error
+from pyrowire.limits.limits import script
+from pyrowire.messaging.client import client, delivery
+from pyrowire.queues.queues import BLOCK_TIMEOUT, ListBackend, worker_id
+from pyrowire.tasks.tasks import HEARTBEAT_INTERVAL
+
+# set to have a persistent sender finish the messages it holds and return, e.g. when its process is asked to shut down
+STOPPING = threading.Event()
+
+# seconds a message that twilio cannot have created waits before it is sent again; doubled after each attempt, up to
+# MAX_RETRY_BACKOFF
+RETRY_BACKOFF = 1
+MAX_RETRY_BACKOFF = 60
+
+# the outbound queue of each topic, by topic, for this process
+OUTBOUND_QUEUES = {}
+
+# moves one message from a sender's processing list to the outbound queue's retry set, to be sent again once it is due,
+# if it is still in the processing list.
+# KEYS: processing list, retry set; ARGV: the message, the message to retry, when it is due
+# returns 1 if the message was moved, 0 if not
+RETRY_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# moves up to ARGV[2] messages that are due by ARGV[1] from the retry set to the head of the outbound queue.
+# KEYS: retry set, outbound queue; returns the number of messages moved
+DUE_SCRIPT = """
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #jobs > 0 then
+    redis.call('ZREM', KEYS[1], unpack(jobs))
+    redis.call('LPUSH', KEYS[2], unpack(jobs))
+end
+return #jobs
+"""
+
+# Outbound queue
+# ----------------------------------------------------------------------------------------------------------------------
+# messages waiting to be sent are json objects in the <topic>.outbound list:
+#   - id: the id the message's result is recorded under
+#   - message_data: the message data object the message is sent from
+#   - key: the key of message_data that holds the text to send, or None to send none
+#   - media_url: the url of the media to send, if any
+#   - attempts: the number of times it was sent before, and twilio could not have created it, if any
+class OutboundQueue(ListBackend):
+    """
+    a topic's outbound messages wait in the <topic>.outbound list, and are moved atomically to a per-sender processing
+    list while they are sent, like jobs on the list backend. a sender that stops sending heartbeats to the topic's
+    <topic>.senders hash has its processing list moved back to the head of the queue. messages to be sent again wait
+    in the <topic>.outbound.retry sorted set, scored by when they are due.
+    """
+    kind = 'outbound'
+
+    def __init__(self, topic=None):
+        """
+        :param topic: the topic
+        """
+        ListBackend.__init__(self, topic)
+        self.key = '%s.%s' % (topic, 'outbound')
+        self.workers = '%s.%s' % (topic, 'senders')
+        self.retries = '%s.%s' % (self.key, 'retry')
+
+    def processing(self, worker=None):
+        return '%s.%s.%s' % (self.key, 'processing', worker or worker_id())
+
+    def retry(self, redis=None, job_id=None, raw_job=None, due=None):
+        """
+        takes one of the current sender's messages in flight off of its processing list, to be sent again once it is due
+        :param redis: the redis client to use
+        :param job_id: the id the message was taken from the queue by
+        :param raw_job: the message to send again, as json
+        :param due: when to send it again, in seconds since the epoch
+        :return: int, 1 if the message was taken, 0 if it was no longer in flight
+        """
+        return script('retry', RETRY_SCRIPT)(keys=[self.processing(), self.retries], args=[job_id, raw_job, repr(due)],
+                                             client=redis)
+
+    def due(self, redis=None, count=100):
+        """
+        hands the messages to be sent again that are due back to the head of the queue
+        :param redis: the redis client to use
+        :param count: the most messages to hand back
+        :return: int, the number of messages handed back
+        """
+        return script('due', DUE_SCRIPT)(keys=[self.retries, self.key], args=[repr(time.time()), count], client=redis)
+
+def outbound_queue(topic=None):
+    """
+    :param topic: the topic
+    :return: OutboundQueue, the topic's outbound queue, one instance per topic per process
+    """
+    if topic not in OUTBOUND_QUEUES:
+        OUTBOUND_QUEUES[topic] = OutboundQueue(topic)
+    return OUTBOUND_QUEUES[topic]
+
+def enqueue(message_data=None, key='reply', media_url=None, redis=None):
+    """
+    queues a message for the topic's sender workers to send
+    :param message_data: the message data object containing the handled message information
+    :param key: the key for the message data object that holds the text to send, or None to send none
+    :param media_url: the url of the media to send, if any
+    :param redis: the redis client to use, defaults to the application's
+    :return: string, the id the message's result will be recorded under
+    """
+    message_id = uuid.uuid4().hex
+    job = {'id': message_id, 'message_data': message_data, 'key': key}
+    if media_url:
+        job['media_url'] = media_url
+    (redis or config.redis_connection()).rpush(outbound_queue(message_data['topic']).key, json.dumps(job))
+    return message_id
+
+# Senders
+# ----------------------------------------------------------------------------------------------------------------------
+def send_outbound(topics=None, persist=True):
+    """
+    sends the messages queued on topics' outbound queues, so that handlers do not wait on twilio. each topic's queue is
+    read by a thread of its own, which keeps up to the topic's concurrency of messages submitted to the topic's messages
+    client; the client sends them on its few keep-alive connections, so no more than those are in flight to twilio at
+    once. each message is only acknowledged once it has been sent, or has failed, and its result recorded. a message
+    that twilio cannot have created, because it could not be reached, or was busy, is sent again after a backoff, up to
+    the topic's max_attempts in all. its result is kept in the topic's <topic>.sent hash, under the message's id, as
+    json holding:
+      - time: when it was sent
+      - number: the number it was sent to
+      - status: 'sent', 'failed', or 'unknown' if twilio may have created it before it failed; it is not sent again
+      - sid: the twilio sid of the message, if it was sent
+      - error: the error it failed with, if it failed
+    if the topic has retention, the hash is indexed by time in <topic>.sent.index. sent and failed messages are also
+    counted in the topic's metrics hash, in its sent and send_failed fields, and failures are logged to the topic's
+    error log.
+    :param topics: list of the topics to send messages for
+    :param persist: boolean, default=True, whether to keep sending indefinitely; if not, returns once the queues are
+                    empty
+    :return: int, the number of messages sent or failed
+    """
+    log_level = config.log_level() or logging.DEBUG
+    logging.basicConfig(level=log_level)
+    logger = logging.getLogger(__name__)
+
+    redis = config.redis_connection()
+    topics = list(topics)
+    senders = [OutboundSender(topic, redis, logger) for topic in topics]
+    threads = [threading.Thread(target=sender.run, args=(persist,)) for sender in senders]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    last_heartbeat = 0
+    while True:
+        try:
+            # send a heartbeat, and re-queue the messages of any senders that have stopped sending theirs
+            if time.time() - last_heartbeat > HEARTBEAT_INTERVAL:
+                last_heartbeat = time.time()
+                for topic in topics:
+                    redis.hset(outbound_queue(topic).workers, worker_id(), last_heartbeat)
+                    outbound_queue(topic).reap(redis)
+        except (ConnectionError, TimeoutError), e:
+            logger.error(e)
+
+        if not persist or STOPPING.is_set():
+            for thread in threads:
+                thread.join()
+            if persist:
+                try:
+                    for topic in topics:
+                        outbound_queue(topic).release(redis)
+                except (ConnectionError, TimeoutError):
+                    pass
+            return sum(sender.count for sender in senders)
+        STOPPING.wait(BLOCK_TIMEOUT)
+
+class OutboundSender(object):
+    """
+    reads a topic's outbound queue, and submits its messages to the topic's messages client, without waiting on them.
+    each message's result is recorded, and the message acknowledged, from the client's sender thread once twilio has
+    answered, so that no more than the topic's concurrency of messages are held at once.
+    """
+
+    def __init__(self, topic=None, redis=None, logger=None):
+        """
+        :param topic: the topic to send messages for
+        :param redis: the redis client to use; shared with the client's sender threads
+        :param logger: the logger to log failures to
+        """
+        self.topic = topic
+        self.redis = redis
+        self.logger = logger
+        self.size = config.outbound(topic, 'concurrency')
+        self.in_flight = 0
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def run(self, persist=True):
+        """
+        sender loop. takes as many messages as there is room for, and submits them
+        :param persist: whether to keep sending until STOPPING is set; if not, returns once the queue is empty
+        """
+        queue = outbound_queue(self.topic)
+        while not STOPPING.is_set():
+            try:
+                queue.due(self.redis)
+                jobs = queue.fetch(self.free_slots(), self.redis, block=persist)
+                if not jobs and not persist:
+                    # the messages in flight may be handed back, to be sent again once they are due
+                    self.drain()
+                    if not queue.due(self.redis):
+                        break
+                for job_id, raw_job in jobs:
+                    self.submit(job_id, raw_job)
+            except (ConnectionError, TimeoutError), e:
+                # messages taken stay in this sender's processing list, and are re-queued once it is released or reaped
+                self.logger.error(e)
+                STOPPING.wait(BLOCK_TIMEOUT)
+        self.drain()
+
+    def free_slots(self):
+        """
+        waits until fewer than the topic's concurrency of messages are in flight
+        :return: int, the number of messages that may be taken
+        """
+        with self.condition:
+            while self.in_flight >= self.size:
+                self.condition.wait(BLOCK_TIMEOUT)
+            return self.size - self.in_flight
+
+    def drain(self):
+        """
+        waits until no messages are in flight
+        """
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait(BLOCK_TIMEOUT)
+
+    def submit(self, job_id=None, raw_job=None):
+        """
+        submits one queued message to the topic's messages client; a message that cannot be read is failed at once
+        :param job_id: the id it was taken from the queue by
+        :param raw_job: the queued message, as json
+        """
+        with self.condition:
+            self.in_flight += 1
+        job = None
+        try:
+            job = json.loads(raw_job)
+            message_data = job['message_data']
+            client(self.topic).submit(to=message_data['number'],
+                                      body=message_data[job['key']] if job.get('key') else None,
+                                      media_url=job.get('media_url'),
+                                      callback=lambda future: self.done(job_id, raw_job, job, future),
+                                      block=True)
+        except Exception, e:
+            self.record(job_id, raw_job, job, None, e)
+
+    def done(self, job_id=None, raw_job=None, job=None, future=None):
+        """
+        records the result of a message twilio has answered, on the client's sender thread
+        :param job_id: the id it was taken from the queue by
+        :param raw_job: the queued message, as json
+        :param job: the queued message
+        :param future: the message's future
+        """
+        error = future.exception()
+        self.record(job_id, raw_job, job, future.result() if error is None else None, error)
+
+    def record(self, job_id=None, raw_job=None, job=None, resource=None, error=None):
+        """
+        records a message's result, and acknowledges it. call from the except block that caught error, if any, so its
+        traceback is logged. a message that failed with an error twilio cannot have created it through is sent again,
+        after a backoff, until it has been tried the topic's max_attempts times. if redis cannot take the result, the
+        message is handed back to the topic's queue, rather than left in flight for as long as the sender is alive.
+        :param job_id: the id it was taken from the queue by
+        :param raw_job: the queued message, as json
+        :param job: the queued message, or None if it could not be read
+        :param resource: the message resource twilio created, if it was sent
+        :param error: the error it failed with, if it failed
+        """
+        retried = False
+        try:
+            now = time.time()
+            attempts = (job or {}).get('attempts', 0) + 1
+            if job and error is not None and delivery(error) == 'error' and \
+                    attempts < config.outbound(self.topic, 'max_attempts'):
+                self.logger.warning('sending message %s again, after attempt %s: %s' % (job.get('id'), attempts, error))
+                due = now + min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+                retried = outbound_queue(self.topic).retry(self.redis, job_id, json.dumps(dict(job, attempts=attempts)),
+                                                           due)
+                return
+            number = (job or {}).get('message_data', {}).get('number')
+            if error is None:
+                result = {'time': now, 'number': number, 'status': 'sent', 'sid': resource.get('sid')}
+            else:
+                status = 'unknown' if delivery(error) == 'unknown' else 'failed'
+                result = {'time': now, 'number': number, 'status': status, 'error': str(error)}
+            message_id = (job or {}).get('id') or uuid.uuid4().hex
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.hset('%s.%s' % (self.topic, 'sent'), message_id, json.dumps(result))
+            if config.retained(self.topic):
+                pipeline.zadd('%s.%s' % (self.topic, 'sent.index'), {message_id: now})
+            if error is not None:
+                log_error(self.topic, error_record(error, job or raw_job, 'sender'), pipeline)
+            pipeline.hincrby('%s.%s' % (self.topic, 'metrics'), 'send_failed' if error is not None else 'sent', 1)
+            outbound_queue(self.topic).ack(pipeline, job_id)
+            pipeline.execute()
+        except (ConnectionError, TimeoutError), e:
+            self.logger.error(e)
+            try:
+                outbound_queue(self.topic).requeue(self.redis, job_id)
+            except (ConnectionError, TimeoutError):
+                # redis is gone; the message is re-queued once this sender is released or reaped
+                pass
+        except Exception, e:
+            # e.g., the error cannot be recorded; acknowledge the message anyway, rather than send it again
+            self.logger.error(e)
+            try:
+                pipeline = self.redis.pipeline(transaction=True)
+                outbound_queue(self.topic).ack(pipeline, job_id)
+                pipeline.execute()
+            except Exception, e:
+                self.logger.error(e)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.count += 0 if retried else 1
+                self.condition.notify_all()
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+from Queue import Queue, Empty, Full
+import threading
+
+import pyrowire.config.configuration as config
+from pyrowire.messaging.send import sms
+
+# per-process reply executor state; rebuilt lazily in each process (e.g., after a gunicorn fork)
+EXECUTOR = {
+    'pid': None,
+    'queue': None,
+    'threads': []
+}
+EXECUTOR_LOCK = threading.Lock()
+
+# Reply executor
+# ----------------------------------------------------------------------------------------------------------------------
+def send_reply(message_data, key='reply'):
+    """
+    hands an outbound sms reply to the process's reply executor without blocking the caller on twilio.
+    if the executor's queue is full, the profile's overflow policy decides what happens to the reply:
+      - drop: the reply is logged and discarded
+      - block: the caller waits up to block_timeout seconds for room, then the reply is dropped
+      - redis: the reply is spilled to the topic's <topic>.replies list in redis, to be sent once there is room. the
+        list is kept apart from the topic's outbound queue, which only the topic's sender workers take from
+    :param message_data: the message data object containing the reply
+    :param key: the key for the message data object that holds the reply
+    :return: boolean, whether the reply was accepted for sending
+    :raise e: TypeError if message_data is None
+    """
+    if not message_data:
+        raise TypeError('message_data must not be None')
+
+    overflow = config.replies('overflow')
+    try:
+        if overflow == 'block':
+            reply_queue().put((message_data, key), timeout=config.replies('block_timeout'))
+        else:
+            reply_queue().put_nowait((message_data, key))
+        return True
+    except Full:
+        if overflow == 'redis':
+            config.redis_connection().rpush(spill_key(message_data['topic']),
+                                            json.dumps({'message_data': message_data, 'key': key}))
+            return True
+        logging.getLogger(__name__).warning('reply queue full, dropping reply to %s' % message_data['number'])
+        return False
+
+def reply_queue():
+    """
+    returns the bounded reply queue for this process, starting the executor's sender threads on first use
+    :return: Queue, the reply queue
+    """
+    if EXECUTOR['pid'] != os.getpid():
+        with EXECUTOR_LOCK:
+            if EXECUTOR['pid'] != os.getpid():
+                EXECUTOR['queue'] = Queue(maxsize=config.replies('max_queue'))
+                EXECUTOR['threads'] = [threading.Thread(target=send_replies, args=(EXECUTOR['queue'],))
+                                       for i in range(config.replies('workers'))]
+                for thread in EXECUTOR['threads']:
+                    thread.daemon = True
+                    thread.start()
+                EXECUTOR['pid'] = os.getpid()
+    return EXECUTOR['queue']
+
+def send_replies(queue):
+    """
+    sender thread loop. takes replies off of the local queue and sends them; when the local queue is idle and the
+    overflow policy is redis, drains any replies that were spilled to the topics' replies lists.
+    :param queue: the reply queue to take replies from
+    """
+    logger = logging.getLogger(__name__)
+    while True:
+        try:
+            message_data, key = queue.get(timeout=1)
+        except Empty:
+            if config.replies('overflow') != 'redis':
+                continue
+            spilled = spilled_reply()
+            if not spilled:
+                continue
+            message_data, key = spilled['message_data'], spilled['key']
+        try:
+            sms(message_data, key=key)
+        except Exception as e:
+            logger.error(e)
+
+def spilled_reply():
+    """
+    pops one spilled reply from the first topic's replies list that has one
+    :return: dict, the spilled reply, or None if there are none
+    """
+    redis = config.redis_connection()
+    for topic in config.topics().keys():
+        spilled = redis.lpop(spill_key(topic))
+        if spilled:
+            return json.loads(spilled)
+    return None
+
+def spill_key(topic=None):
+    """
+    :param topic: the topic
+    :return: string, the key of the list the topic's replies are spilled to
+    """
+    return '%s.%s' % (topic, 'replies')
@@ -0,0 +1,41 @@
+import twilio.twiml as twiml
+
+# rendered twiml bodies for the static replies in the topic settings, keyed by reply text; None is the empty response
+RESPONSES = {}
+
+# TwiML responses
+# ----------------------------------------------------------------------------------------------------------------------
+def prerender(topics=None):
+    """
+    renders the twiml body of every static reply in the topic settings, so the ingest route can serve them
+    without building a twiml tree per request
+    :param topics: the topics dict from the settings
+    """
+    for settings in topics.values():
+        texts = [None, settings['accept_response'], settings['error_response']] + settings['validators'].values()
+        for block in ['rate_limit', 'backpressure']:
+            texts.append(settings.get(block, {}).get('response'))
+        for text in texts:
+            render(text)
+
+def render(text=None):
+    """
+    returns the twiml body replying with a static message, rendering and caching it on first use
+    :param text: the reply text, or None for a response with no reply
+    :return: string, the twiml body
+    """
+    body = RESPONSES.get(text)
+    if body is None:
+        body = RESPONSES[text] = dynamic(text)
+    return body
+
+def dynamic(text=None):
+    """
+    renders a twiml body without caching it, for replies that differ per message
+    :param text: the reply text, or None for a response with no reply
+    :return: string, the twiml body
+    """
+    response = twiml.Response()
+    if text:
+        response.message(text)
+    return str(response)
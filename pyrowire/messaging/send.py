@@ -1,72 +1,126 @@
 import logging
 
-from twilio.rest import TwilioRestClient
-
 import pyrowire.config.configuration as config
+from pyrowire.messaging.client import MessageFuture, client
+from pyrowire.messaging.outbound import enqueue
+
+logger = logging.getLogger(__name__)
 
 
 # Twilio methods - SMS
 # ----------------------------------------------------------------------------------------------------------------------
-def sms(message_data, key='reply'):
+def sms(message_data, key='reply', queue=None):
     """
-    wrapper function around the twilio.rest api to send a message
+    sends a message through the twilio messages api, on this process's cached client for the topic, or queues it for
+    the topic's sender workers to send
     :param message_data: the message data object containing the handled message information
     :param key: the key for the message data object that holds the final response
-    :return: boolean, whether the twilio message was created successfully.
+    :param queue: whether to queue the message rather than send it; defaults to the topic's outbound queue setting
+    :return: boolean, whether the twilio message was created (or queued) successfully.
     :raise e: TypeError if message_data is None
     """
     if not message_data:
         raise TypeError('message_data must not be None')
 
-    logging.basicConfig(level=config.log_level())
-    logger = logging.getLogger(__name__)
-
-    if not message_data:
-        logger.error(TypeError('Message data must be provided'))
-        return False
-
-    twilio_config = config.twilio(message_data['topic'])
-    twilio_client = TwilioRestClient(twilio_config['account_sid'], twilio_config['auth_token'])
     try:
-        twilio_client.messages.create(to=message_data['number'], from_=twilio_config['from_number'], body=message_data[key])
+        topic, body = message_data['topic'], message_data[key]
+        queued = config.outbound(topic, 'queue') if queue is None else queue
+        if queued:
+            enqueue(message_data, key=key)
+        else:
+            client(topic).create(to=message_data['number'], body=body)
         return True
     except Exception, e:
         logger.error(e)
         return False
 
-def mms(message_data, include_text=False, text_key='reply', media_url=None):
+def mms(message_data, include_text=False, text_key='reply', media_url=None, queue=None):
     """
-    wrapper function around the twilio.rest api to send a message
+    sends a media message through the twilio messages api, on this process's cached client for the topic, or queues it
+    for the topic's sender workers to send
     ** Currently only works with Short Codes in the US **
     :param message_data: the message data object containing the handled message information
-    :param key: the key for the message data object that holds the final response
-    :return: boolean, whether the twilio message was created successfully.
+    :param include_text: whether to send the text held by text_key along with the media
+    :param text_key: the key for the message data object that holds the text
+    :param media_url: the url of the media to send
+    :param queue: whether to queue the message rather than send it; defaults to the topic's outbound queue setting
+    :return: boolean, whether the twilio message was created (or queued) successfully.
     :raise e: TypeError if message_data is None
     """
     if not message_data:
         raise TypeError('message_data must not be None')
 
-    logging.basicConfig(level=config.log_level())
-    logger = logging.getLogger(__name__)
-
-    if not message_data or not media_url:
-        missing_item = 'data' if not message_data else 'media_url'
-        logger.error(TypeError('Message %s must be provided' % missing_item))
+    if not media_url:
+        logger.error(TypeError('Message media_url must be provided'))
         return False
 
-    twilio_config = config.twilio(message_data['topic'])
-    twilio_client = TwilioRestClient(twilio_config['account_sid'], twilio_config['auth_token'])
     try:
-        if include_text:
-            twilio_client.messages.create(to=message_data['number'],
-                                          from_=twilio_config['from_number'],
-                                          body=message_data[text_key],
-                                          media_url=media_url)
+        topic, body = message_data['topic'], message_data[text_key] if include_text else None
+        queued = config.outbound(topic, 'queue') if queue is None else queue
+        if queued:
+            enqueue(message_data, key=text_key if include_text else None, media_url=media_url)
         else:
-            twilio_client.messages.create(to=message_data['number'],
-                                          from_=twilio_config['from_number'],
-                                          media_url=media_url)
+            client(topic).create(to=message_data['number'], body=body, media_url=media_url)
         return True
     except Exception, e:
         logger.error(e)
         return False
+
+# Twilio methods - asynchronous
+# ----------------------------------------------------------------------------------------------------------------------
+def async_sms(message_data, key='reply', timeout=None, callback=None):
+    """
+    submits a message to this process's cached client for the topic, and returns without waiting on twilio. the
+    message is sent on one of the client's few keep-alive connections, so many messages may be in flight at once
+    :param message_data: the message data object containing the handled message information
+    :param key: the key for the message data object that holds the final response
+    :param timeout: seconds to wait on twilio, once the message has waited its turn; defaults to the topic's timeout
+    :param callback: a function to call with the future once the message has been created, or has failed
+    :return: MessageFuture, the future of the twilio message resource
+    :raise e: TypeError if message_data is None
+    """
+    if not message_data:
+        raise TypeError('message_data must not be None')
+
+    try:
+        topic, number, body = message_data['topic'], message_data['number'], message_data[key]
+    except KeyError, e:
+        return failed(e, callback)
+    return client(topic).submit(to=number, body=body, timeout=timeout, callback=callback)
+
+def async_mms(message_data, include_text=False, text_key='reply', media_url=None, timeout=None, callback=None):
+    """
+    submits a media message to this process's cached client for the topic, and returns without waiting on twilio
+    ** Currently only works with Short Codes in the US **
+    :param message_data: the message data object containing the handled message information
+    :param include_text: whether to send the text held by text_key along with the media
+    :param text_key: the key for the message data object that holds the text
+    :param media_url: the url of the media to send
+    :param timeout: seconds to wait on twilio, once the message has waited its turn; defaults to the topic's timeout
+    :param callback: a function to call with the future once the message has been created, or has failed
+    :return: MessageFuture, the future of the twilio message resource
+    :raise e: TypeError if message_data is None
+    """
+    if not message_data:
+        raise TypeError('message_data must not be None')
+
+    try:
+        if not media_url:
+            raise TypeError('Message media_url must be provided')
+        topic, number = message_data['topic'], message_data['number']
+        body = message_data[text_key] if include_text else None
+    except (KeyError, TypeError), e:
+        return failed(e, callback)
+    return client(topic).submit(to=number, body=body, media_url=media_url, timeout=timeout, callback=callback)
+
+def failed(error=None, callback=None):
+    """
+    :param error: the error a message failed with before it could be submitted
+    :param callback: a function to call with the future
+    :return: MessageFuture, a future that has already failed with the error
+    """
+    future = MessageFuture()
+    if callback:
+        future.add_done_callback(callback)
+    future.set_exception(error)
+    return future
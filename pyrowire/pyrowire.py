@@ -1,7 +1,9 @@
 from flask import Flask
+from redis import ConnectionPool, Redis
 
 import config.configuration as config
 import runner.runner as runner
+from messaging.responses import prerender
 from validators.validators import profanity, parseable, length
 from routes.queue_message import queue_message
 
@@ -10,7 +12,8 @@ FLASK.register_blueprint(queue_message, url_prefix='/queue')
 
 def configure(settings):
     """
-    wires up configuration for pyrowire app, sets Flask logging level to level from config settings
+    wires up configuration for pyrowire app, sets Flask logging level to level from config settings, builds the
+    redis connection pool shared by the web routes and workers of this process, and renders the static twiml replies
     :param settings: the settings.py file that configures the application
     :raises TypeError if settings is NoneType
     """
@@ -18,12 +21,29 @@ def configure(settings):
         raise TypeError('Settings must not be None.')
 
     config.configure(settings, FLASK)
+    config.set_redis_connection(redis_connection())
     config.add_validator(profanity)
     config.add_validator(parseable)
     config.add_validator(length)
+    prerender(config.topics())
 
     FLASK.logger.setLevel(config.log_level())
 
+def redis_connection():
+    """
+    builds a redis client backed by a bounded connection pool, using the redis settings of the current profile.
+    redis-py resets the pool in a forked child, so each process ends up with its own pool.
+    :return: Redis, a client bound to the new connection pool
+    """
+    pool = ConnectionPool(host=config.redis('host'),
+                          port=int(config.redis('port')),
+                          db=int(config.redis('db')),
+                          password=config.redis('password') or None,
+                          max_connections=config.redis_pool_option('max_connections'),
+                          socket_timeout=config.redis_pool_option('socket_timeout'),
+                          socket_connect_timeout=config.redis_pool_option('socket_connect_timeout'))
+    return Redis(connection_pool=pool)
+
 if __name__ == '__main__':
     import resources.settings
     configure(resources.settings, FLASK)
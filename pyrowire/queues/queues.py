@@ -0,0 +1,380 @@
+from collections import deque
+import os
+import socket
+import time
+
+from redis.exceptions import ResponseError
+
+import pyrowire.config.configuration as config
+from pyrowire.limits.limits import script
+
+# seconds a worker blocks on an empty queue before looping; keep this below the redis socket_timeout, if one is set
+BLOCK_TIMEOUT = 1
+# most tokens a topic's wake list keeps; each token wakes one waiting shared worker, and a token left over from a job
+# another worker already took only wakes a worker to find nothing
+WAKE_TOKENS = 16
+# seconds since its last heartbeat before a worker is considered dead
+STALE_AFTER = 60
+# the consumer group all of a topic's workers read its stream as
+GROUP = 'workers'
+
+# moves up to ARGV[1] jobs from the head of the submitted queue to the tail of a worker's processing list, in order.
+# KEYS: submitted queue, processing list; returns the jobs moved
+FETCH_SCRIPT = """
+local jobs = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #jobs > 0 then
+    redis.call('LTRIM', KEYS[1], #jobs, -1)
+    redis.call('RPUSH', KEYS[2], unpack(jobs))
+end
+return jobs
+"""
+
+# moves every job in a dead worker's processing list back to the head of the submitted queue, oldest job first, and
+# forgets the worker. does nothing if the worker has sent a heartbeat since the deadline.
+# KEYS: processing list, submitted queue, workers hash; ARGV: worker id, deadline
+# returns the number of jobs re-queued, or -1 if the worker is alive
+REAP_SCRIPT = """
+local seen = tonumber(redis.call('HGET', KEYS[3], ARGV[1]))
+if seen and seen > tonumber(ARGV[2]) then
+    return -1
+end
+local count = 0
+while redis.call('RPOPLPUSH', KEYS[1], KEYS[2]) do
+    count = count + 1
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+return count
+"""
+
+# moves one job from a worker's processing list back to the head of the submitted queue, if it is still there.
+# KEYS: processing list, submitted queue; ARGV: the job; returns 1 if the job was moved, 0 if not
+REQUEUE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) > 0 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# takes jobs from many topics' queues at once, in the order given: from each topic, up to its quota of jobs from the
+# head of its submitted queue, moved to the tail of its processing list, until ARGV[1] jobs have been taken in all.
+# KEYS: submitted queue and processing list of each topic; ARGV: most jobs to take in all, then each topic's quota
+# returns a flat list of (topic index, job) pairs
+FAIR_FETCH_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local taken = {}
+for i = 1, #KEYS / 2 do
+    if limit <= 0 then
+        break
+    end
+    local quota = math.min(tonumber(ARGV[i + 1]), limit)
+    if quota > 0 then
+        local jobs = redis.call('LRANGE', KEYS[2 * i - 1], 0, quota - 1)
+        if #jobs > 0 then
+            redis.call('LTRIM', KEYS[2 * i - 1], #jobs, -1)
+            redis.call('RPUSH', KEYS[2 * i], unpack(jobs))
+            for _, job in ipairs(jobs) do
+                taken[#taken + 1] = i
+                taken[#taken + 1] = job
+            end
+            limit = limit - #jobs
+        end
+    end
+end
+return taken
+"""
+
+# the backend of each topic, by topic, for this process
+BACKENDS = {}
+
+def backend(topic=None):
+    """
+    :param topic: the topic
+    :return: the queue backend the topic is configured to use, one instance per topic per process
+    """
+    kind = config.queue(topic, 'backend')
+    if topic not in BACKENDS or BACKENDS[topic].kind != kind:
+        BACKENDS[topic] = QUEUE_BACKENDS[kind](topic)
+    return BACKENDS[topic]
+
+def worker_id():
+    """
+    :return: string, the id of the current worker process, unique across hosts
+    """
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+def wake_key(topic=None):
+    """
+    :param topic: the topic
+    :return: string, the key of the list the ingest script pushes a token onto for each job queued for a shared topic
+    """
+    return '%s.%s' % (topic, 'wake')
+
+def processing_list(topic=None, worker=None):
+    """
+    :param topic: the topic the worker works for
+    :param worker: the worker id, defaults to the current worker
+    :return: string, the key of the list holding the worker's jobs in flight
+    """
+    return '%s.%s.%s' % (topic, 'processing', worker or worker_id())
+
+# Queue backends
+# ----------------------------------------------------------------------------------------------------------------------
+# a backend holds a topic's submitted jobs from the time the ingest script queues them until a worker acknowledges
+# them as complete or failed. jobs are handed to workers as (job id, raw job) tuples; the job id is what the job is
+# acknowledged by. each backend has:
+#   - kind: the name it is configured by, and that the ingest script queues by
+#   - key: the key of the queue
+#   - depth(redis): the number of jobs queued; redis may be a pipeline
+#   - fetch(count, redis, block): takes up to count jobs, blocking up to BLOCK_TIMEOUT seconds if none are queued
+#   - ack(pipeline, job_id): adds the commands that acknowledge a job to a pipeline
+#   - requeue(redis, job_id): hands one of the current worker's jobs in flight back, if its result cannot be recorded
+#   - reap(redis): recovers the jobs of workers that died while holding them
+#   - release(redis): hands back the current worker's jobs in flight, and signs it off
+class ListBackend(object):
+    """
+    the default backend. jobs wait in the <topic>.submitted list, and are moved atomically to a per-worker processing
+    list while they are handled. a worker that stops sending heartbeats has its processing list moved back to the head
+    of the queue.
+    """
+    kind = 'list'
+
+    def __init__(self, topic=None):
+        """
+        :param topic: the topic
+        """
+        self.topic = topic
+        self.key = '%s.%s' % (topic, 'submitted')
+        self.workers = '%s.%s' % (topic, 'workers')
+
+    def processing(self, worker=None):
+        """
+        :param worker: the worker id, defaults to the current worker
+        :return: string, the key of the list holding the worker's jobs in flight
+        """
+        return processing_list(self.topic, worker)
+
+    def depth(self, redis=None):
+        return redis.llen(self.key)
+
+    def fetch(self, count=1, redis=None, block=True):
+        processing = self.processing()
+        if count > 1 or not block:
+            raw_jobs = script('fetch', FETCH_SCRIPT)(keys=[self.key, processing], args=[count], client=redis)
+            if raw_jobs or not block:
+                return [(raw_job, raw_job) for raw_job in raw_jobs]
+        raw_job = redis.execute_command('BLMOVE', self.key, processing, 'LEFT', 'RIGHT', BLOCK_TIMEOUT)
+        return [(raw_job, raw_job)] if raw_job else []
+
+    def ack(self, pipeline=None, job_id=None):
+        pipeline.lrem(self.processing(), 1, job_id)
+
+    def requeue(self, redis=None, job_id=None):
+        return script('requeue', REQUEUE_SCRIPT)(keys=[self.processing(), self.key], args=[job_id], client=redis)
+
+    def reap(self, redis=None):
+        deadline = time.time() - STALE_AFTER
+        requeued = 0
+        for worker, seen in redis.hgetall(self.workers).items():
+            if float(seen) < deadline:
+                keys = [self.processing(worker), self.key, self.workers]
+                requeued += max(0, script('reap', REAP_SCRIPT)(keys=keys, args=[worker, repr(deadline)], client=redis))
+        return requeued
+
+    def release(self, redis=None):
+        keys = [self.processing(), self.key, self.workers]
+        # a deadline no heartbeat can be later than
+        return script('reap', REAP_SCRIPT)(keys=keys, args=[worker_id(), repr(time.time() + 1e9)], client=redis)
+
+class StreamBackend(object):
+    """
+    jobs are entries of the <topic>.stream stream, read by a consumer group that every worker of the topic is a
+    consumer of. a job is pending for the worker it was delivered to until the worker acknowledges it, and is then
+    deleted from the stream, so the stream only holds jobs that are queued or in flight. pending jobs that have gone
+    unacknowledged for the topic's claim_after seconds are claimed by the next worker to reap, and handled by it.
+    the stream is never trimmed, since every entry in it is a job still to be handled; bound it with the topic's
+    backpressure max_queue_depth.
+    """
+    kind = 'stream'
+
+    def __init__(self, topic=None):
+        """
+        :param topic: the topic
+        """
+        self.topic = topic
+        self.key = '%s.%s' % (topic, 'stream')
+        # jobs claimed from dead consumers, to be handled before new ones are read
+        self.claimed = deque()
+
+    def depth(self, redis=None):
+        return redis.xlen(self.key)
+
+    def fetch(self, count=1, redis=None, block=True):
+        if self.claimed:
+            return [self.claimed.popleft() for i in range(min(count, len(self.claimed)))]
+        return [job for key, job in read_streams([self.key], count, redis, BLOCK_TIMEOUT * 1000 if block else None)]
+
+    def ack(self, pipeline=None, job_id=None):
+        pipeline.xack(self.key, GROUP, job_id)
+        pipeline.xdel(self.key, job_id)
+
+    def requeue(self, redis=None, job_id=None):
+        # a pending entry cannot be handed back to the group; it is claimed by the next worker to reap once it has been
+        # pending for claim_after seconds
+        return 0
+
+    def reap(self, redis=None):
+        claim_after = config.queue(self.topic, 'claim_after')
+        try:
+            # XAUTOCLAIM replies with the id to continue from and the entries claimed. an entry deleted from the stream
+            # while pending is dropped from the pending list from redis 7; before, it is claimed, and comes back as nil
+            reply = redis.execute_command('XAUTOCLAIM', self.key, GROUP, worker_id(), int(claim_after * 1000), '0-0',
+                                          'COUNT', 100)
+            consumers = redis.xinfo_consumers(self.key, GROUP)
+        except ResponseError, e:
+            if 'NOGROUP' not in str(e):
+                raise
+            return 0
+        claimed = 0
+        for entry in reply[1]:
+            if entry and entry[1]:
+                entry_id, fields = entry[0], dict(zip(entry[1][::2], entry[1][1::2]))
+                self.claimed.append((entry_id, fields['job']))
+                claimed += 1
+        if not all(entry and entry[1] for entry in reply[1]):
+            self.ack_deleted(redis)
+        # consumers that have nothing pending and have not read in a while are gone; forget them
+        for consumer in consumers:
+            if consumer['name'] != worker_id() and not consumer['pending'] and \
+                    consumer['idle'] > max(claim_after, STALE_AFTER) * 1000:
+                redis.xgroup_delconsumer(self.key, GROUP, consumer['name'])
+        deadline = time.time() - STALE_AFTER
+        for worker, seen in redis.hgetall('%s.%s' % (self.topic, 'workers')).items():
+            if float(seen) < deadline:
+                redis.hdel('%s.%s' % (self.topic, 'workers'), worker)
+        return claimed
+
+    def ack_deleted(self, redis=None):
+        """
+        acknowledges the entries pending for the current worker that are no longer in the stream. before redis 7,
+        XAUTOCLAIM claims such an entry without saying which it is, and keeps it pending, to be claimed on every reap.
+        :param redis: the redis client to use
+        :return: int, the number of entries acknowledged
+        """
+        pending = redis.xpending_range(self.key, GROUP, '-', '+', 1000, worker_id())
+        pipeline = redis.pipeline(transaction=False)
+        for entry in pending:
+            pipeline.xrange(self.key, entry['message_id'], entry['message_id'])
+        deleted = [entry['message_id'] for entry, found in zip(pending, pipeline.execute()) if not found]
+        return redis.xack(self.key, GROUP, *deleted) if deleted else 0
+
+    def release(self, redis=None):
+        # pending entries cannot be handed back to the group; any this worker could not acknowledge are claimed by
+        # another once they have been pending for claim_after seconds
+        redis.hdel('%s.%s' % (self.topic, 'workers'), worker_id())
+        return 0
+
+def read_streams(keys=None, count=1, redis=None, block=None):
+    """
+    reads new entries from streams as a consumer of their workers' group, creating the group if it does not exist yet
+    :param keys: list of the keys of the streams
+    :param count: the most entries to read from each stream
+    :param redis: the redis client to use
+    :param block: the most milliseconds to wait for an entry, or None not to wait
+    :return: list of (stream key, (job id, raw job)) tuples
+    """
+    streams = dict((key, '>') for key in keys)
+    try:
+        read = redis.xreadgroup(GROUP, worker_id(), streams, count=count, block=block)
+    except ResponseError, e:
+        if 'NOGROUP' not in str(e):
+            raise
+        for key in keys:
+            create_group(key, redis)
+        read = redis.xreadgroup(GROUP, worker_id(), streams, count=count, block=block)
+    return [(key, (entry_id, fields['job'])) for key, entries in read or [] for entry_id, fields in entries]
+
+def create_group(key=None, redis=None):
+    """
+    creates the workers' consumer group of a stream, and the stream, if either does not exist yet. the group starts at
+    the beginning of the stream, so no job queued before it was created is missed.
+    :param key: the key of the stream
+    :param redis: the redis client to use
+    """
+    try:
+        redis.xgroup_create(key, GROUP, id='0', mkstream=True)
+    except ResponseError, e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+QUEUE_BACKENDS = {
+    ListBackend.kind: ListBackend,
+    StreamBackend.kind: StreamBackend
+}
+
+# Many topics
+# ----------------------------------------------------------------------------------------------------------------------
+def fetch_fair(topics=None, quotas=None, limit=1, redis=None):
+    """
+    moves jobs from many topics' queues into this worker's care, without blocking. the topics on list backends are
+    served in one round trip for each run of them in the order given; each topic on a stream backend costs one more.
+    :param topics: list of the topics, in the order to serve them
+    :param quotas: list of the most jobs to take from each topic
+    :param limit: the most jobs to take in all
+    :param redis: the redis client to use
+    :return: list of (topic, (job id, raw job)) tuples
+    """
+    jobs = []
+    lists = []
+    for topic, quota in zip(topics, quotas) + [(None, 0)]:
+        queue = backend(topic) if topic else None
+        if lists and (queue is None or queue.kind != ListBackend.kind):
+            jobs.extend(fetch_lists(lists, limit - len(jobs), redis))
+            lists = []
+        if not quota or len(jobs) >= limit:
+            continue
+        if queue.kind == ListBackend.kind:
+            lists.append((topic, quota))
+        else:
+            jobs.extend((topic, job) for job in queue.fetch(min(quota, limit - len(jobs)), redis, block=False))
+    return jobs
+
+def fetch_lists(served=None, limit=1, redis=None):
+    """
+    :param served: list of (topic, quota) tuples of topics on list backends, in the order to serve them
+    :param limit: the most jobs to take in all
+    :param redis: the redis client to use
+    :return: list of (topic, (job id, raw job)) tuples
+    """
+    if limit <= 0:
+        return []
+    keys = []
+    for topic, quota in served:
+        keys.extend([backend(topic).key, processing_list(topic)])
+    taken = script('fair_fetch', FAIR_FETCH_SCRIPT)(keys=keys, args=[limit] + [quota for topic, quota in served],
+                                                     client=redis)
+    return [(served[int(taken[i]) - 1][0], (taken[i + 1], taken[i + 1])) for i in range(0, len(taken), 2)]
+
+def wait_for_job(topics=None, redis=None):
+    """
+    waits on many topics' queues for up to BLOCK_TIMEOUT seconds, and takes the first job to arrive. a lone list is
+    waited on with BLMOVE, and streams alone with a blocking group read. redis cannot block on many lists and move the
+    job popped in one command, so otherwise the worker blocks on the topics' wake lists, which the ingest script pushes
+    a token onto for each job it queues for a shared topic, and then takes a job with the fair fetch; either way, a job
+    is only ever moved atomically to its processing list. a job handed back by a reap or requeue pushes no token, and
+    is taken by the worker's next fetch, within BLOCK_TIMEOUT seconds.
+    :param topics: list of the topics to wait on
+    :param redis: the redis client to use
+    :return: list of (topic, (job id, raw job)) tuples, empty if no job arrived, or another worker took it first
+    """
+    lists = [topic for topic in topics if backend(topic).kind == ListBackend.kind]
+    streams = dict((backend(topic).key, topic) for topic in topics if backend(topic).kind == StreamBackend.kind)
+    if not streams and len(lists) == 1:
+        return [(lists[0], job) for job in backend(lists[0]).fetch(1, redis)]
+    if not lists:
+        # up to one entry is read from each stream
+        jobs = read_streams(streams.keys(), 1, redis, BLOCK_TIMEOUT * 1000)
+        return [(streams[key], job) for key, job in jobs]
+    if redis.blpop([wake_key(topic) for topic in topics], BLOCK_TIMEOUT) is None:
+        return []
+    return fetch_fair(topics, [1] * len(topics), 1, redis)
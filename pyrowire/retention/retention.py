@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+import pyrowire.config.configuration as config
+from pyrowire.limits.limits import script
+
+# the histories kept for each topic; each is a hash with a sorted set beside it, <history>.index, that scores each of
+# the hash's fields by the time it was written. the error log is a stream, and is trimmed by entry id instead
+HISTORIES = ('complete', 'sent')
+
+# removes up to ARGV[3] of a history's oldest entries that are older than the cutoff, or beyond its max entries, from
+# both the hash and its index.
+# KEYS: history hash, index; ARGV: cutoff time ('' for none), max entries (0 for none), chunk size
+# returns the number of entries removed
+TRIM_SCRIPT = """
+local chunk, max_entries = tonumber(ARGV[3]), tonumber(ARGV[2])
+local doomed = {}
+if ARGV[1] ~= '' then
+    doomed = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1], 'LIMIT', 0, chunk)
+end
+if max_entries > 0 and #doomed < chunk then
+    local excess = redis.call('ZCARD', KEYS[2]) - max_entries - #doomed
+    if excess > 0 then
+        -- the entries already doomed by age are the lowest ranked, so the oldest beyond those come next
+        local extra = redis.call('ZRANGE', KEYS[2], #doomed, #doomed + math.min(excess, chunk - #doomed) - 1)
+        for _, field in ipairs(extra) do
+            doomed[#doomed + 1] = field
+        end
+    end
+end
+if #doomed > 0 then
+    redis.call('HDEL', KEYS[1], unpack(doomed))
+    redis.call('ZREM', KEYS[2], unpack(doomed))
+end
+return #doomed
+"""
+
+def compact(topic=None, redis=None, now=None):
+    """
+    trims the topic's complete and sent histories to its retention settings, a chunk at a time, so that redis is never
+    blocked for long and workers keep writing in between, and its error log likewise.
+    :param topic: the topic to compact
+    :param redis: the redis client to use
+    :param now: the current time
+    :return: int, the number of entries removed
+    """
+    now = now or time.time()
+    max_age = config.retention(topic, 'max_age')
+    max_entries = config.retention(topic, 'max_entries')
+    chunk = config.retention(topic, 'chunk')
+    cutoff = repr(now - max_age) if max_age else ''
+    removed = 0
+    for history in HISTORIES:
+        key = '%s.%s' % (topic, history)
+        index_unindexed(key, redis, chunk)
+        while True:
+            trimmed = script('trim', TRIM_SCRIPT)(keys=[key, '%s.index' % key], args=[cutoff, max_entries or 0, chunk],
+                                                  client=redis)
+            removed += trimmed
+            if trimmed < chunk:
+                break
+    # stream entry ids start with the millisecond they were added at
+    errors = '%s.%s' % (topic, 'errors')
+    if max_age:
+        removed += redis.execute_command('XTRIM', errors, 'MINID', '~', int((now - max_age) * 1000))
+    if max_entries:
+        removed += redis.execute_command('XTRIM', errors, 'MAXLEN', '~', max_entries)
+    return removed
+
+def index_unindexed(key=None, redis=None, chunk=500):
+    """
+    adds the fields of a history hash that are missing from its index, such as ones written before retention was set
+    up, to the index as the oldest entries, so they are the first to be trimmed
+    :param key: the key of the history hash
+    :param redis: the redis client to use
+    :param chunk: the most fields to look at per round trip
+    :return: int, the number of fields indexed
+    """
+    if redis.hlen(key) <= redis.zcard('%s.index' % key):
+        return 0
+    indexed = 0
+    cursor = '0'
+    while True:
+        cursor, fields = redis.hscan(key, cursor, count=chunk)
+        if fields:
+            # NX, so the fields that are indexed keep their times
+            indexed += redis.zadd('%s.index' % key, dict((field, 0) for field in fields), nx=True)
+        if not int(cursor):
+            return indexed
+
+# Compactor
+# ----------------------------------------------------------------------------------------------------------------------
+class Compactor(threading.Thread):
+    """
+    compacts the histories of topics with retention settings in the background, each every interval seconds. a lock
+    in redis keeps any two compactors, e.g. on different hosts, from compacting the same topic at once.
+    """
+
+    def __init__(self, topics=None):
+        """
+        :param topics: list of the topics to compact
+        """
+        super(Compactor, self).__init__()
+        self.daemon = True
+        self.topics = [topic for topic in topics if config.retained(topic)]
+        self.logger = logging.getLogger(__name__)
+        self.stopping = threading.Event()
+
+    def run(self):
+        due = {}
+        while not self.stopping.is_set():
+            for topic in self.topics:
+                if time.time() >= due.get(topic, 0):
+                    due[topic] = time.time() + config.retention(topic, 'interval')
+                    self.compact(topic)
+            self.stopping.wait(1)
+
+    def compact(self, topic=None):
+        """
+        compacts a topic, unless another compactor has in the last interval seconds
+        :param topic: the topic to compact
+        :return: int, the number of entries removed, or None if the topic was not compacted
+        """
+        redis = config.redis_connection()
+        try:
+            if not redis.set('%s.%s' % (topic, 'compaction'), time.time(), nx=True,
+                             ex=int(config.retention(topic, 'interval'))):
+                return None
+            removed = compact(topic, redis)
+            if removed:
+                self.logger.info('compacted %s: %s entries removed' % (topic, removed))
+            return removed
+        except (ConnectionError, TimeoutError), e:
+            self.logger.error(e)
+
+    def stop(self):
+        self.stopping.set()
@@ -1,20 +1,76 @@
-from datetime import datetime
+from collections import OrderedDict
 import json
-from multiprocessing import Process
+import threading
 import time
 
 from flask import Blueprint, request, current_app
-from redis import Redis
 from redis.exceptions import ConnectionError, TimeoutError
-import twilio.twiml as twiml
 
 import pyrowire.config.configuration as config
+from pyrowire.errors.errors import error_record, log_error
+from pyrowire.limits.limits import TOKEN_BUCKET_LUA, script
 from pyrowire.messaging.message import message_from_request
-from pyrowire.messaging.send import sms
+from pyrowire.messaging.replies import send_reply
+from pyrowire.messaging.responses import render
+from pyrowire.queues.queues import WAKE_TOKENS, backend, wake_key
 
 
 queue_message = Blueprint('message_queue', __name__)
 
+# outcomes of the ingest script, by status code; each is also the field of the topic's metrics hash that counts it
+STATUSES = ('accepted', 'duplicate', 'throttled', 'busy', 'rejected')
+ACCEPTED, DUPLICATE, THROTTLED, BUSY, REJECTED = range(len(STATUSES))
+
+# admits an inbound message in one round trip: dedupe on the message sid, check the queue depth, take rate limit
+# tokens, queue the message if it passed validation, remember the reply for the sid, and count the outcome.
+# a message queued for a topic that shares a worker also pushes a token onto the topic's wake list, which the shared
+# worker blocks on; the list keeps at most ARGV[9] tokens.
+# KEYS: sid key, queue, metrics hash, wake list, then any rate limit buckets
+# ARGV: now, dedupe ttl (0 for none), max queue depth (0 for none), message json ('' if it failed validation),
+#       reply if admitted, busy reply, throttled reply, queue backend kind, wake tokens to keep (0 for none), then a
+#       (rate, burst) pair per rate limit bucket
+# returns {status, twiml reply}
+INGEST_SCRIPT = TOKEN_BUCKET_LUA + """
+local statuses = {'%s'}
+local now, ttl, max_depth = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+if ttl > 0 then
+    local previous = redis.call('GET', KEYS[1])
+    if previous then
+        redis.call('HINCRBY', KEYS[3], 'duplicate', 1)
+        return {1, previous}
+    end
+end
+local status, reply = 0, ARGV[5]
+local stream = ARGV[8] == 'stream'
+if max_depth > 0 and redis.call(stream and 'XLEN' or 'LLEN', KEYS[2]) >= max_depth then
+    status, reply = 3, ARGV[6]
+elseif take_token({unpack(KEYS, 5)}, ARGV, 10, now) > 0 then
+    status, reply = 2, ARGV[7]
+elseif ARGV[4] ~= '' then
+    if stream then
+        redis.call('XADD', KEYS[2], '*', 'job', ARGV[4])
+    else
+        redis.call('RPUSH', KEYS[2], ARGV[4])
+    end
+    local wake = tonumber(ARGV[9])
+    if wake > 0 then
+        redis.call('LPUSH', KEYS[4], 1)
+        redis.call('LTRIM', KEYS[4], 0, wake - 1)
+    end
+else
+    status = 4
+end
+if ttl > 0 then
+    redis.call('SET', KEYS[1], reply, 'EX', ttl)
+end
+redis.call('HINCRBY', KEYS[3], statuses[status + 1], 1)
+return {status, reply}
+""" % "', '".join(STATUSES)
+
+# per-process cache of the most recent twiml responses, per topic, keyed by message sid
+RECENT_RESPONSES = {}
+RECENT_RESPONSES_LOCK = threading.Lock()
+
 @queue_message.route('/<topic>', methods=['GET', 'POST'])
 def queue(topic):
     """
@@ -24,51 +80,126 @@ def queue(topic):
     ensures body passes through all defined filters for the topic
     if filters pass, mobile number and message are queued in Redis for processing by worker(s).
     response is sent back using twiml based on outcome
+    :return: the twiml response, as text/xml
+    """
+    return current_app.response_class(ingest(topic), mimetype='text/xml')
+
+def ingest(topic):
+    """
+    validates the inbound message, then admits and queues it with a single round trip to redis, and picks the reply
+    to it. static replies are served from the twiml bodies rendered at configure time.
+    :param topic: the topic the message was sent to
     :return: string form of twiml response
     """
     message = message_from_request(request=request)
-    redis = Redis(config.redis('host'), int(config.redis('port')), int(config.redis('db')), config.redis('password'))
-    response = twiml.Response()
+    redis = config.redis_connection()
     try:
+        # dedupe block
+        # --------------------------------------------------------------------------------------------------------------
+        # twilio retries webhooks that time out; a retry of a message this process answered recently gets the same
+        # response, without a round trip to redis. retries that land on another process are caught by the ingest script
+        recent = recent_response(topic, message['sid'])
+        if recent is not None:
+            return recent
+
         # validator block
         # --------------------------------------------------------------------------------------------------------------
-        # for each validator that is to be applied to the topic
-        for name, func in [k for k in config.validators().items() if k[0] in config.validators(topic).keys()]:
-            # run the message against the validator
-            message_invalid = func(message)
-            # if it fails to pass validation, get the error message, and return it to the SMS sender
-            if message_invalid:
-                message['validator_error'] = config.validators(topic)[name]
-                # kick off parallel thread to handle response without blocking
-                Process(target=sms, kwargs={'data': message, 'key': 'validator_error'}).start()
-                # set the twiml response to the validator error message
-                response.message(config.validators(topic)[name])
-                return str(response)
-
-        # if the message passed all filter validations, queue message in redis, and set the reply to successful
-        redis.rpush('%s.%s' % (topic, 'submitted'), json.dumps(message))
-        message['response'] = config.accept_response(topic)
-
-        # if the twilio application is set to respond on successful receipt of message, send the accept message back.
-        if config.send_on_accept(topic):
-            # kick off parallel thread to handle response without blocking
-            Process(target=sms, kwargs={'data': message, 'key': 'response'}).start()
-
-        response.message(config.accept_response(topic))
-        return str(response)
+        # for each validator that is to be applied to the topic, in the order compiled at configure time, run the
+        # message against the validator, and stop at the first one it fails to pass
+        validator_error = None
+        for func, error_response in config.validator_chain(topic):
+            if func(message):
+                validator_error = error_response
+                break
+
+        # admission block
+        # --------------------------------------------------------------------------------------------------------------
+        # the ingest script dedupes the message, checks the topic's queue depth and rate limits, and queues the message
+        # if it passed validation, all in one round trip
+        status, reply = admit(topic, message, validator_error, redis)
+
+        if status == ACCEPTED and config.send_on_accept(topic):
+            # if the twilio application is set to respond on successful receipt of message, hand the accept message to
+            # the reply executor so it is sent without blocking; the twiml response is then empty, so it is sent once
+            message['response'] = config.accept_response(topic)
+            send_reply(message, key='response')
+
+        return remember_response(topic, message['sid'], reply)
 
     except (ConnectionError, TimeoutError, KeyError, TypeError) as e:
         # if the error was not a redis connection or timeout error, log the error to redis
-        # if the log to redis fails, let it go
         if type(e) in [KeyError, TypeError]:
             try:
-                timestamp = time.time()
-                date_timestamp = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-                error = {'message': message, 'error': str(e)}
-                redis.hset('%s.error' % topic, date_timestamp, error)
-            except:
-                pass
+                log_error(topic, error_record(e, message, 'ingest'), redis)
+            except Exception:
+                current_app.logger.exception('could not log error for topic %s' % topic)
         # log the error and return the topic's error response
-        current_app.logger.log(e)
-        response.message(config.error_response(topic))
-        return str(response)
+        current_app.logger.error(e)
+        return render(config.error_response(topic))
+
+# Admission
+# ----------------------------------------------------------------------------------------------------------------------
+def admit(topic, message, validator_error, redis):
+    """
+    runs the ingest script for an inbound message, which, atomically:
+      - answers a message whose sid was already received (within the topic's dedupe ttl) with its earlier reply
+      - turns the message away as busy if the topic's queue is at its max_queue_depth
+      - turns the message away as throttled if its sender or the topic is over its rate limit
+      - queues the message, if it passed validation, and wakes the worker if the topic shares one
+      - remembers the reply for the message sid, and counts the outcome in the topic's metrics hash
+    a message that is admitted is answered in the twiml response with the validator error it failed, or with the
+    accept response, unless the topic sends that through the reply executor instead
+    :param topic: the topic the message was sent to
+    :param message: the message data
+    :param validator_error: the error response of the validator the message failed, or None if it passed validation
+    :param redis: the redis client to use
+    :return: tuple of (status, reply); status is one of the STATUSES codes, reply is the twiml body to answer with
+    """
+    queue = backend(topic)
+    keys = ['%s.sid.%s' % (topic, message['sid']), queue.key, '%s.%s' % (topic, 'metrics'), wake_key(topic)]
+    args = [repr(time.time()),
+            config.dedupe(topic, 'ttl'),
+            config.backpressure(topic, 'max_queue_depth') or 0,
+            '' if validator_error else json.dumps(message),
+            render(validator_error or (None if config.send_on_accept(topic) else config.accept_response(topic))),
+            render(config.backpressure(topic, 'response')),
+            render(config.rate_limit(topic, 'response')),
+            queue.kind,
+            WAKE_TOKENS if config.shared(topic) else 0]
+    for scope, key in [('number', '%s.rate.%s' % (topic, message['number'])), ('topic', '%s.rate' % topic)]:
+        limit = config.rate_limit(topic, scope)
+        if limit:
+            keys.append(key)
+            args.extend([limit['rate'], limit['burst']])
+
+    status, reply = script('ingest', INGEST_SCRIPT)(keys=keys, args=args, client=redis)
+    return status, reply
+
+# Recent responses
+# ----------------------------------------------------------------------------------------------------------------------
+def recent_response(topic, sid):
+    """
+    looks up the response this process recently gave a message sid
+    :param topic: the topic the message was sent to
+    :param sid: the twilio message sid
+    :return: string, the twiml response, or None if the sid is not in the cache
+    """
+    with RECENT_RESPONSES_LOCK:
+        return RECENT_RESPONSES.get(topic, {}).get(sid)
+
+def remember_response(topic, sid, response):
+    """
+    adds the response for a message sid to the per-process cache of recent responses, if the topic has one
+    :param topic: the topic the message was sent to
+    :param sid: the twilio message sid
+    :param response: string, the twiml response
+    :return: string, the twiml response
+    """
+    size = config.dedupe(topic, 'local_cache') if config.dedupe(topic, 'ttl') else 0
+    if size:
+        with RECENT_RESPONSES_LOCK:
+            cache = RECENT_RESPONSES.setdefault(topic, OrderedDict())
+            cache[sid] = response
+            while len(cache) > size:
+                cache.popitem(last=False)
+    return response
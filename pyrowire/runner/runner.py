@@ -1,8 +1,26 @@
+import json
+import logging
+import math
 import os
+import signal
+import socket
+import time
 from multiprocessing import Process
 
 import pyrowire.config.configuration as config
-from pyrowire.tasks.tasks import process_queue_item
+import pyrowire.messaging.outbound as outbound
+from pyrowire.queues.queues import backend
+from pyrowire.retention.retention import Compactor
+from pyrowire.tasks.tasks import STOPPING, process_queue_item, process_queues
+
+# seconds to wait before restarting a worker that exited, doubled for each exit in a row, up to RESTART_BACKOFF_MAX
+RESTART_BACKOFF = 1
+RESTART_BACKOFF_MAX = 60
+# seconds a worker must run before an exit no longer counts toward its backoff
+STABLE_AFTER = 30
+# seconds the supervisor waits between checks on its workers, and for them to finish their jobs on shutdown
+SUPERVISE_INTERVAL = 0.5
+SHUTDOWN_TIMEOUT = 10
 
 # run, server, work
 # ----------------------------------------------------------------------------------------------------------------------
@@ -11,16 +29,24 @@ def run():
     called once per application launch. loads profanity, and starts either the web process, a worker, or both.
     If a run type is specified by the "RUN" environment variable, runs only that process. Otherwise, runs web
     and worker processes together for a standalone application server.
+    workers are run under a supervisor, which keeps each topic's configured number of worker processes running.
+    topics that set shared share a single worker process. a sender process sends the messages
+    queued on the outbound queues of the topics given (RUN=sender), or, standalone, of the topics that queue them.
     """
     if 'RUN' in os.environ.keys():
         if os.environ['RUN'].lower() == 'web':
             server()
         elif os.environ['RUN'].lower() == 'worker':
             assert 'TOPIC' in os.environ.keys(), "You must provide a topic as an env var (TOPIC=my_topic)"
-            work(topic=os.environ['TOPIC'])
+            supervise(topics=os.environ['TOPIC'].split(','))
+        elif os.environ['RUN'].lower() == 'sender':
+            assert 'TOPIC' in os.environ.keys(), "You must provide a topic as an env var (TOPIC=my_topic)"
+            sender(topics=os.environ['TOPIC'].split(','))
     else:
-        for topic in config.topics().keys():
-            Process(target=work, kwargs={'topic': topic}).start()
+        Process(target=supervise, kwargs={'topics': config.topics().keys()}).start()
+        queued = [topic for topic in config.topics().keys() if config.outbound(topic, 'queue')]
+        if queued:
+            Process(target=sender, kwargs={'topics': queued}).start()
         Process(target=server).run()
 
 def server():
@@ -39,3 +65,277 @@ def work(topic=None, persist=True):
                    one pass. In production mode, this should always be True, and True is what it defaults to.
    """
     return process_queue_item(topic=topic, persist=persist)
+
+def worker(topic=None):
+    """
+    entry point of a supervised worker process. on SIGTERM, the worker finishes the jobs it holds and exits.
+    :param topic: the topic for which to run a worker, or a tuple of topics for a worker to share
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: STOPPING.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if isinstance(topic, tuple):
+        process_queues(topics=list(topic))
+    else:
+        work(topic=topic)
+
+def sender(topics=None):
+    """
+    entry point of a sender process. on SIGTERM or SIGINT, the sender finishes the messages it holds and exits.
+    :param topics: list of the topics to send queued messages for
+    """
+    stop = lambda signum, frame: outbound.STOPPING.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    outbound.send_outbound(topics=topics)
+
+# Supervisor
+# ----------------------------------------------------------------------------------------------------------------------
+def supervise(topics=None):
+    """
+    runs each topic's configured number of worker processes until SIGTERM or SIGINT, then shuts them down gracefully
+    :param topics: list of the topics to run workers for
+    """
+    supervisor = Supervisor(topics)
+    stop = lambda signum, frame: supervisor.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    supervisor.run()
+
+class Supervisor(object):
+    """
+    preforks worker processes for a set of topics, restarts any that exit with an exponential backoff, and shuts them
+    all down on stop(). each topic gets a pool of its own, unless it sets shared; two or more that do share one worker
+    process, and are kept in this supervisor's topics as a tuple. each worker slot is a (topic, index) pair, so a
+    topic's workers can be told apart.
+    """
+
+    def __init__(self, topics=None):
+        """
+        :param topics: list of the topics to run workers for
+        """
+        topics = list(topics or [])
+        shared = tuple(topic for topic in topics if config.shared(topic))
+        # a topic with no other to share with runs as if it did not set shared
+        shared = shared if len(shared) > 1 else ()
+        dedicated = [topic for topic in topics if topic not in shared]
+        self.topics = dedicated + ([shared] if shared else [])
+        self.autoscalers = dict((topic, Autoscaler(topic)) for topic in dedicated
+                                if config.autoscale(topic, 'max_workers'))
+        self.logger = logging.getLogger(__name__)
+        self.stopping = False
+        # per slot: the worker process, when it started, its exits in a row, and when it may next be started
+        self.processes = {}
+        self.started = {}
+        self.failures = {}
+        self.not_before = {}
+
+    def target(self, topic=None):
+        """
+        :param topic: the topic, or a tuple of topics sharing a worker
+        :return: int, the number of worker processes the topic should have
+        """
+        if isinstance(topic, tuple):
+            return 1
+        if topic in self.autoscalers:
+            return self.autoscalers[topic].workers
+        return config.workers(topic)
+
+    def run(self):
+        """
+        checks on the workers every SUPERVISE_INTERVAL seconds until stopped, then shuts them down. the histories of
+        topics with retention settings are compacted in the background meanwhile.
+        """
+        compactor = Compactor(self.all_topics())
+        if compactor.topics:
+            compactor.start()
+        while not self.stopping:
+            self.check()
+            time.sleep(SUPERVISE_INTERVAL)
+        compactor.stop()
+        self.shutdown()
+
+    def all_topics(self):
+        """
+        :return: list of every topic the supervisor runs workers for
+        """
+        return [topic for unit in self.topics for topic in (unit if isinstance(unit, tuple) else (unit,))]
+
+    def stop(self):
+        """
+        asks the supervisor to shut its workers down and return from run()
+        """
+        self.stopping = True
+
+    def check(self):
+        """
+        starts each topic's missing workers, unless they are backing off after an exit, and stops any beyond the
+        topic's target
+        """
+        now = time.time()
+        for autoscaler in self.autoscalers.values():
+            try:
+                autoscaler.sample(now)
+            except Exception, e:
+                # keep the current pool size until redis can be sampled again
+                self.logger.error(e)
+        for topic in self.topics:
+            target = self.target(topic)
+            for index in range(target):
+                slot = (topic, index)
+                process = self.processes.get(slot)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    self.exited(slot, now)
+                if now >= self.not_before.get(slot, 0):
+                    self.start(slot, now)
+            for slot in [s for s in self.processes if s[0] == topic and s[1] >= target]:
+                self.retire(slot)
+
+    def start(self, slot=None, now=None):
+        """
+        forks a worker process for a slot
+        :param slot: tuple of (topic, index)
+        :param now: the time it was started
+        """
+        process = Process(target=worker, kwargs={'topic': slot[0]})
+        process.start()
+        self.processes[slot] = process
+        self.started[slot] = now
+
+    def exited(self, slot=None, now=None):
+        """
+        records a worker's exit, and backs off the slot's next start
+        :param slot: tuple of (topic, index)
+        :param now: the time the exit was seen
+        """
+        process = self.processes.pop(slot)
+        if now - self.started.get(slot, now) >= STABLE_AFTER:
+            self.failures[slot] = 0
+        failures = self.failures.get(slot, 0)
+        delay = min(RESTART_BACKOFF * 2 ** failures, RESTART_BACKOFF_MAX)
+        self.failures[slot] = failures + 1
+        self.not_before[slot] = now + delay
+        self.logger.error('worker %s for topic %s exited with code %s; restarting in %ss' %
+                          (process.pid, slot[0], process.exitcode, delay))
+
+    def retire(self, slot=None):
+        """
+        asks a worker to finish its jobs and exit, and forgets its slot
+        :param slot: tuple of (topic, index)
+        """
+        process = self.processes.pop(slot)
+        self.failures.pop(slot, None)
+        self.not_before.pop(slot, None)
+        if process.is_alive():
+            process.terminate()
+
+    def shutdown(self):
+        """
+        asks every worker to finish its jobs and exit, and kills any still running after SHUTDOWN_TIMEOUT seconds
+        """
+        processes = self.processes.values()
+        self.processes = {}
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for process in processes:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+# Autoscaler
+# ----------------------------------------------------------------------------------------------------------------------
+class Autoscaler(object):
+    """
+    sizes a topic's local worker pool to its backlog. every interval seconds, samples the depth of the topic's queue
+    and how many jobs all of its workers processed since the last sample, and works out how long the backlog would
+    take to clear at that rate:
+      - above scale_up_backlog seconds, adds as many workers as it would take to clear it in that time
+      - below scale_down_backlog seconds, and cooldown seconds after the last change, removes a worker
+    always staying between min_workers and max_workers. each decision is recorded in the topic's autoscale hash, by
+    supervisor, and counted in its metrics hash.
+    """
+
+    def __init__(self, topic=None):
+        """
+        :param topic: the topic to size the worker pool of
+        """
+        self.topic = topic
+        self.id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.logger = logging.getLogger(__name__)
+        self.workers = self.bounded(config.workers(topic))
+        self.sampled = None
+        self.processed = 0
+        self.changed = 0
+
+    def bounded(self, workers=None):
+        """
+        :param workers: a number of workers
+        :return: int, the number of workers, within the topic's bounds
+        """
+        return max(config.autoscale(self.topic, 'min_workers'), min(config.autoscale(self.topic, 'max_workers'),
+                                                                     workers))
+
+    def sample(self, now=None):
+        """
+        samples the topic's backlog and processing rate, if it is time to, and resizes the pool
+        :param now: the current time
+        :return: int, the number of workers the topic should have
+        """
+        if self.sampled is not None and now - self.sampled < config.autoscale(self.topic, 'interval'):
+            return self.workers
+        redis = config.redis_connection()
+        pipeline = redis.pipeline(transaction=False)
+        backend(self.topic).depth(pipeline)
+        pipeline.hget('%s.%s' % (self.topic, 'metrics'), 'processed')
+        backlog, processed = pipeline.execute()
+        processed = int(processed or 0)
+
+        if self.sampled is not None:
+            rate = max(0, processed - self.processed) / float(now - self.sampled)
+            workers = self.decide(backlog, rate, now)
+            if workers != self.workers:
+                self.record(backlog, rate, workers, now, redis)
+        self.sampled, self.processed = now, processed
+        return self.workers
+
+    def decide(self, backlog=0, rate=0, now=None):
+        """
+        :param backlog: the number of jobs waiting
+        :param rate: the jobs processed per second by all of the topic's workers
+        :param now: the current time
+        :return: int, the number of workers the topic should have
+        """
+        scale_up_backlog = config.autoscale(self.topic, 'scale_up_backlog')
+        if backlog and (not rate or backlog / rate > scale_up_backlog):
+            if not rate:
+                # nothing to go on yet but a backlog that is not moving; double up
+                return self.bounded(self.workers * 2)
+            per_worker = rate / self.workers
+            return self.bounded(max(self.workers + 1, int(math.ceil(backlog / (per_worker * scale_up_backlog)))))
+        if (backlog / rate if rate else 0) < config.autoscale(self.topic, 'scale_down_backlog') and \
+                now - self.changed >= config.autoscale(self.topic, 'cooldown'):
+            return self.bounded(self.workers - 1)
+        return self.workers
+
+    def record(self, backlog=0, rate=0, workers=None, now=None, redis=None):
+        """
+        resizes the pool, and records the decision
+        :param backlog: the number of jobs waiting
+        :param rate: the jobs processed per second by all of the topic's workers
+        :param workers: the new number of workers
+        :param now: the current time
+        :param redis: the redis client to use
+        """
+        action = 'scale_up' if workers > self.workers else 'scale_down'
+        self.logger.info('%s %s from %s to %s workers; backlog %s, %.1f jobs/s' %
+                         (action, self.topic, self.workers, workers, backlog, rate))
+        self.workers, self.changed = workers, now
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.hset('%s.%s' % (self.topic, 'autoscale'), self.id,
+                      json.dumps({'time': now, 'action': action, 'workers': workers, 'backlog': backlog, 'rate': rate}))
+        pipeline.hincrby('%s.%s' % (self.topic, 'metrics'), action, 1)
+        pipeline.execute()
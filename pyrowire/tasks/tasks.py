@@ -1,19 +1,30 @@
-from datetime import datetime
 import json
 import logging
+import threading
 import time
-import uuid
+from multiprocessing.pool import ThreadPool
 
-from redis import Redis
 from redis.exceptions import ConnectionError, TimeoutError
 
 import pyrowire.config.configuration as config
+from pyrowire.errors.errors import error_record, log_error
+from pyrowire.queues.queues import BLOCK_TIMEOUT, backend, fetch_fair, wait_for_job, worker_id
 from pyrowire.resources.settings import *
 
+# seconds between a worker's heartbeats
+HEARTBEAT_INTERVAL = 5
+
+# set to have a persistent worker finish the jobs it holds and return, e.g. when its process is asked to shut down
+STOPPING = threading.Event()
+
 def process_queue_item(topic=None, persist=True):
     """
     method that block pops items from a redis queue and processes them according to the defined processor for the topic.
-    default behavior is persistent, i.e., will run as long as the worker is alive.
+    jobs are taken from the topic's queue backend, and only acknowledged once they have been handled, so jobs in
+    flight when a worker dies are recovered by the next worker to reap it.
+    when the queue has a backlog, up to the topic's batch_size jobs are taken, and completed, in one round trip each.
+    if the topic's concurrency is more than one, that many jobs are handled at once on a pool of threads.
+    default behavior is persistent, i.e., will run as long as the worker is alive, or until STOPPING is set.
     :param topic: string, the topic for which to process queue items
     :param persist: boolean, default=True, whether to keep the process alive indefinitely
     :return: implicit None if persistent, explicit None if not persistent
@@ -23,38 +34,360 @@ def process_queue_item(topic=None, persist=True):
     logging.basicConfig(level=log_level)
     logger = logging.getLogger(__name__)
 
-    redis = Redis(config.redis('host'), int(config.redis('port')), int(config.redis('db')), config.redis('password'))
-    job_data = None
+    redis = config.redis_connection()
+    queue = backend(topic)
+    concurrency = config.concurrency(topic)
+    pool = HandlerPool(topic, concurrency, redis, logger) if concurrency > 1 else None
+    # heartbeats are sent from a thread of their own, so a worker busy with a slow job is not taken for dead
+    heartbeats = Heartbeats([topic], redis, logger).start()
     job_sid = None
 
     while True:
         try:
-            queue, job_data = redis.blpop('%s.%s' % (topic, 'submitted'))
-            # if job_data was found, i.e., there was an item in queue, proceed. If not, wait for the next one
-            if job_data:
-                job_data = json.loads(job_data)
-                job_sid = job_data['sid']
-                # insert the record for this job into the pending queue for this topic
-                redis.hset('%s.%s' % (topic, 'pending'), uuid, json.dumps(job_data))
-                # attempt to process the message
-                final_job_data = config.handler(topic)(job_data)
-                # add job to complete queue and remove from pending queue
-                redis.hdel('%s.%s' % (topic, 'pending'),
-                           job_sid)
-                redis.hset('%s.%s' % (topic, 'complete'),
-                           job_sid, json.dumps(final_job_data))
-        except (ConnectionError, TimeoutError, IndexError, TypeError, KeyError), e:
-            # if the error was not a redis connection or timeout error, log the error to redis
-            # if the log to redis fails, let it go
-            if type(e) in [KeyError, TypeError]:
+            if pool:
+                # take only as many jobs as there are free threads, and hand them to the pool; each is completed from
+                # its thread once handled, so the jobs in flight never outnumber the topic's concurrency
+                count = min(config.batch_size(topic), pool.free_slots())
+                for job in queue.fetch(count, redis):
+                    pool.submit(job)
+            else:
+                completed, failed = [], []
+                # if jobs were found, i.e., there were items in queue, proceed. If not, wait for the next one
+                for job in queue.fetch(config.batch_size(topic), redis):
+                    job_sid = handle_job(topic, job, completed, failed, logger) or job_sid
+
+                # add jobs to complete queue or error log, and acknowledge them
+                complete_jobs(topic, completed, failed, redis)
+        except (ConnectionError, TimeoutError), e:
+            # jobs this worker still holds will not be completed; once the ones being handled are done, put them back
+            # in the queue. if that fails too, they are re-queued once this worker's heartbeat goes stale
+            try:
+                if pool:
+                    pool.drain()
+                release(topic, redis)
+            except:
+                pass
+            logger.error(e)
+
+        if not persist or STOPPING.is_set():
+            if pool:
+                job_sid = pool.drain() or job_sid
+                pool.close()
+            heartbeats.stop()
+            if persist:
+                # hand back anything still held, and sign off, rather than wait for this worker's heartbeat to go stale
                 try:
-                    timestamp = time.time()
-                    date_timestamp = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-                    error = {'message': job_data, 'error': str(e)}
-                    redis.hset('%s.error' % topic, date_timestamp, error)
-                except:
+                    release(topic, redis)
+                except (ConnectionError, TimeoutError):
                     pass
+            return job_sid
+
+def handle_job(topic=None, job=None, completed=None, failed=None, logger=None):
+    """
+    runs the topic's handler on a job, and adds the job to the completed or failed list. any error fails the job,
+    rather than the worker, so that a job the handler cannot handle is not re-queued to fail every worker in turn.
+    :param topic: the topic the job belongs to
+    :param job: tuple of (job id, raw job), as taken from the queue
+    :param completed: list of (job id, job sid, final job data) tuples to add the job to if it was handled
+    :param failed: list of (job id, error record) tuples to add the job to if it failed
+    :param logger: the logger to log failures to
+    :return: string, the job's sid, or None if the job failed
+    """
+    job_id, raw_job = job
+    job_data = None
+    try:
+        job_data = json.loads(raw_job)
+        job_sid = job_data['sid']
+        # attempt to process the message
+        completed.append((job_id, job_sid, config.handler(topic)(job_data)))
+        return job_sid
+    except Exception, e:
+        # the job is logged to the topic's errors, rather than re-queued
+        failed.append((job_id, error_record(e, job_data or raw_job, 'worker')))
+        logger.error(e)
+
+def complete_jobs(topic=None, completed=None, failed=None, redis=None):
+    """
+    records the final data of handled jobs in the topic's complete hash, indexed by time if the topic has retention, and
+    the errors of failed jobs in its error log, acknowledges all of them to the topic's queue backend, and counts them
+    as processed in the topic's metrics hash. the state transitions are sent as one pipelined MULTI/EXEC, so they cost
+    one round trip and a job is never both recorded and still in flight.
+    :param topic: the topic the jobs belong to
+    :param completed: list of (job id, job sid, final job data) tuples
+    :param failed: list of (job id, error record) tuples
+    :param redis: the redis client to use
+    """
+    if not completed and not failed:
+        return
+    queue = backend(topic)
+    now = time.time()
+    # a topic without retention is never trimmed, so it skips the index; fields written before it has retention are
+    # indexed by the compactor, as the oldest
+    indexed = config.retained(topic)
+    pipeline = redis.pipeline(transaction=True)
+    for job_id, job_sid, final_job_data in completed or []:
+        pipeline.hset('%s.%s' % (topic, 'complete'), job_sid, json.dumps(final_job_data))
+        if indexed:
+            pipeline.zadd('%s.%s' % (topic, 'complete.index'), {job_sid: now})
+        queue.ack(pipeline, job_id)
+    for job_id, record in failed or []:
+        log_error(topic, record, pipeline)
+        queue.ack(pipeline, job_id)
+    pipeline.hincrby('%s.%s' % (topic, 'metrics'), 'processed', len(completed or []) + len(failed or []))
+    pipeline.execute()
+
+# Multi-topic worker
+# ----------------------------------------------------------------------------------------------------------------------
+def process_queues(topics=None, persist=True):
+    """
+    serves many topics from one worker process, so that quiet topics do not each need an interpreter of their own.
+    jobs are taken in rounds of weighted round-robin: each round starts at the next topic in turn, and takes up to each
+    topic's weight in jobs, but never so many that the topic has more than its concurrency in flight, or that more
+    jobs are in flight than the worker has threads. a busy topic therefore cannot starve the others. when every queue
+    is empty, the worker waits on all of them at once.
+    :param topics: list of the topics to serve
+    :param persist: boolean, default=True, whether to keep the process alive indefinitely
+    :return: implicit None if persistent, the sid of the last job handled if not
+    """
+    log_level = config.log_level() or logging.DEBUG
+    logging.basicConfig(level=log_level)
+    logger = logging.getLogger(__name__)
+
+    redis = config.redis_connection()
+    topics = list(topics)
+    size = min(sum(config.concurrency(topic) for topic in topics), config.worker_threads())
+    pool = HandlerPool(None, size, redis, logger)
+    heartbeats = Heartbeats(topics, redis, logger).start()
+    turn = 0
+
+    while True:
+        try:
+            free = pool.free_slots()
+            order = topics[turn:] + topics[:turn]
+            turn = (turn + 1) % len(topics)
+            quotas = [max(0, min(config.weight(topic), config.concurrency(topic) - pool.in_flight_for(topic)))
+                      for topic in order]
+
+            jobs = fetch_fair(order, quotas, free, redis)
+            if not jobs:
+                ready = [topic for topic, quota in zip(order, quotas) if quota]
+                if ready:
+                    jobs = wait_for_job(ready, redis)
+                else:
+                    # every topic is at its concurrency; wait for one of its jobs to finish
+                    pool.wait()
+            for topic, job in jobs:
+                pool.submit(job, topic)
+        except (ConnectionError, TimeoutError), e:
+            try:
+                pool.drain()
+                for topic in topics:
+                    release(topic, redis)
+            except:
+                pass
             logger.error(e)
 
-        if not persist:
+        if not persist or STOPPING.is_set():
+            job_sid = pool.drain()
+            pool.close()
+            heartbeats.stop()
+            if persist:
+                try:
+                    for topic in topics:
+                        release(topic, redis)
+                except (ConnectionError, TimeoutError):
+                    pass
             return job_sid
+
+# Concurrent handlers
+# ----------------------------------------------------------------------------------------------------------------------
+class HandlerPool(object):
+    """
+    runs topics' handlers on a bounded pool of threads, for handlers that spend most of their time waiting on other
+    services. each job is left unacknowledged until its thread has handled it and recorded it as complete or failed,
+    so a job is never acknowledged before it is done.
+    """
+
+    def __init__(self, topic=None, size=1, redis=None, logger=None):
+        """
+        :param topic: the topic whose handler to run, unless another is given with a job
+        :param size: the most jobs to handle at once
+        :param redis: the redis client to record results with; shared by the threads
+        :param logger: the logger to log failures to
+        """
+        self.topic = topic
+        self.size = size
+        self.redis = redis
+        self.logger = logger
+        self.in_flight = 0
+        self.topic_in_flight = {}
+        self.last_sid = None
+        self.condition = threading.Condition()
+        self.pool = ThreadPool(size)
+
+    def free_slots(self):
+        """
+        waits until fewer than size jobs are in flight
+        :return: int, the number of jobs that may be submitted
+        """
+        with self.condition:
+            while self.in_flight >= self.size:
+                self.condition.wait(BLOCK_TIMEOUT)
+            return self.size - self.in_flight
+
+    def in_flight_for(self, topic=None):
+        """
+        :param topic: the topic
+        :return: int, the number of the topic's jobs in flight
+        """
+        with self.condition:
+            return self.topic_in_flight.get(topic, 0)
+
+    def wait(self, timeout=BLOCK_TIMEOUT):
+        """
+        waits until a job in flight is done, or for timeout seconds
+        :param timeout: the most seconds to wait
+        """
+        with self.condition:
+            if self.in_flight:
+                self.condition.wait(timeout)
+
+    def submit(self, job=None, topic=None):
+        """
+        hands a job to a free thread
+        :param job: tuple of (job id, raw job), as taken from the queue
+        :param topic: the topic the job belongs to, if not the pool's
+        """
+        topic = topic or self.topic
+        with self.condition:
+            self.in_flight += 1
+            self.topic_in_flight[topic] = self.topic_in_flight.get(topic, 0) + 1
+        self.pool.apply_async(self.run, (job, topic))
+
+    def run(self, job=None, topic=None):
+        """
+        handles one job and records the result, on a pool thread. if redis cannot take the result, the job is handed
+        back to the topic's queue, rather than left in flight for as long as the worker is alive.
+        :param job: tuple of (job id, raw job), as taken from the queue
+        :param topic: the topic the job belongs to
+        """
+        completed, failed = [], []
+        try:
+            job_sid = handle_job(topic, job, completed, failed, self.logger)
+            complete_jobs(topic, completed, failed, self.redis)
+            if job_sid:
+                self.last_sid = job_sid
+        except (ConnectionError, TimeoutError), e:
+            self.logger.error(e)
+            try:
+                backend(topic).requeue(self.redis, job[0])
+            except (ConnectionError, TimeoutError):
+                # redis is gone; the worker's main loop releases its jobs once it finds so too
+                pass
+        except Exception, e:
+            # e.g., the final data cannot be serialized; fail the job, rather than hand it back to fail again
+            self.logger.error(e)
+            try:
+                complete_jobs(topic, None, [(job[0], error_record(e, job[1], 'worker'))], self.redis)
+            except Exception, e:
+                self.logger.error(e)
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.topic_in_flight[topic] -= 1
+                self.condition.notify_all()
+
+    def drain(self):
+        """
+        waits until no jobs are in flight
+        :return: string, the sid of the last job handled
+        """
+        with self.condition:
+            while self.in_flight:
+                self.condition.wait(BLOCK_TIMEOUT)
+        return self.last_sid
+
+    def close(self):
+        """
+        stops the pool's threads, once the jobs in flight are done
+        """
+        self.pool.close()
+        self.pool.join()
+
+# Worker bookkeeping
+# ----------------------------------------------------------------------------------------------------------------------
+class Heartbeats(object):
+    """
+    sends a worker's heartbeats to its topics, and re-queues the jobs of any of their workers that have stopped sending
+    theirs, on a thread of its own, so that a worker is kept alive however long it spends on its jobs.
+    """
+
+    def __init__(self, topics=None, redis=None, logger=None):
+        """
+        :param topics: list of the topics the worker works for
+        :param redis: the redis client to use
+        :param logger: the logger to log failures to
+        """
+        self.topics = topics
+        self.redis = redis
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """
+        sends the first heartbeat, so the worker is known before it takes a job, and starts the thread
+        :return: Heartbeats, self
+        """
+        self.beat()
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            self.beat()
+
+    def beat(self):
+        try:
+            for topic in self.topics:
+                heartbeat(topic, self.redis)
+                reap(topic, self.redis)
+        except (ConnectionError, TimeoutError), e:
+            self.logger.error(e)
+
+    def stop(self):
+        """
+        stops the heartbeats; do so before releasing the worker, so no heartbeat signs it back on
+        """
+        self.stopped.set()
+        self.thread.join()
+
+def heartbeat(topic=None, redis=None):
+    """
+    records that the current worker is alive in the topic's workers hash
+    :param topic: the topic the worker works for
+    :param redis: the redis client to use
+    :return: float, the time of the heartbeat
+    """
+    now = time.time()
+    redis.hset('%s.%s' % (topic, 'workers'), worker_id(), now)
+    return now
+
+def reap(topic=None, redis=None):
+    """
+    recovers the jobs in flight of every worker of the topic that has died, so that they are processed by another
+    :param topic: the topic to reap
+    :param redis: the redis client to use
+    :return: int, the number of jobs recovered
+    """
+    return backend(topic).reap(redis)
+
+def release(topic=None, redis=None):
+    """
+    hands the current worker's jobs in flight back to the topic's queue, and signs the worker off
+    :param topic: the topic the worker works for
+    :param redis: the redis client to use
+    :return: int, the number of jobs handed back
+    """
+    return backend(topic).release(redis)
@@ -0,0 +1,56 @@
+from collections import deque
+
+# Aho-Corasick automaton
+# ----------------------------------------------------------------------------------------------------------------------
+def build(terms):
+    """
+    compiles a list of terms into an Aho-Corasick automaton, so that a text can be checked for all of the terms in a
+    single pass over its characters, no matter how many terms there are.
+    :param terms: iterable of strings to match
+    :return: tuple of (goto, fail, matches); per state, the outgoing transitions, the fallback state, and whether
+             any term ends at that state
+    """
+    goto = [{}]
+    matches = [False]
+    for term in terms:
+        state = 0
+        for c in term:
+            if c not in goto[state]:
+                goto.append({})
+                matches.append(False)
+                goto[state][c] = len(goto) - 1
+            state = goto[state][c]
+        matches[state] = True
+
+    # breadth-first, so each state's fallback is resolved before any of its children
+    fail = [0] * len(goto)
+    pending = deque(goto[0].values())
+    while pending:
+        state = pending.popleft()
+        for c, child in goto[state].items():
+            fallback = fail[state]
+            while fallback and c not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[child] = goto[fallback].get(c, 0)
+            # a term also ends here if one ends at the fallback, e.g. 'ass' inside 'bass'
+            matches[child] = matches[child] or matches[fail[child]]
+            pending.append(child)
+
+    return tuple(goto), tuple(fail), tuple(matches)
+
+def search(automaton, text):
+    """
+    checks whether any of the automaton's terms occur in a text
+    :param automaton: an automaton returned by build()
+    :param text: the text to check
+    :return: boolean, whether any term was found
+    """
+    goto, fail, matches = automaton
+    state = 0
+    for c in text:
+        while state and c not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(c, 0)
+        if matches[state]:
+            return True
+    return False
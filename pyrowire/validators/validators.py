@@ -1,31 +1,36 @@
-import itertools
+import re
 
 import pyrowire.config as config
 from pyrowire.resources import profanity as profanity_terms
+from pyrowire.validators import automaton
+
+# the profanity terms, compiled once per process. terms with spaces or capitals can never occur in a message once its
+# spaces are removed and it is lowercased, so they are left out
+PROFANITY = automaton.build(t for t in profanity_terms.profanity if t == t.replace(' ', '').lower())
+
+# characters every topic accepts: alphanumerics and the punctuation reasonable to expect in a text message (e.g.,
+# '|' and '\' are not included), plus the space
+PARSEABLE_CHARACTERS = u''.join(unichr(c) for c in range(97, 123) + range(65, 91) + range(48, 58) + range(33, 43) +
+                                range(44, 48) + [58, 63, 64, 94, 32])
+
+# compiled patterns matching any character a topic does not accept, keyed by the topic's extra parseable characters
+PARSEABLE_PATTERNS = {}
 
 # default validators
 # ----------------------------------------------------------------------------------------------------------------------
 def profanity(message_data):
     """
     message filter that ensures none of the terms found in the profanity set are found in the message
-    being sent to the application. Uses itertools to take while terms do not match the message. As soon as a match
-    is found the loop breaks. If no matches are found (message is not profane) length of _not_in list will equal
-    the length of the profanity terms list.
+    being sent to the application. The terms are compiled into an Aho-Corasick automaton at import, so the message,
+    with spaces removed and lowercased, is checked against all of them in a single pass.
     :param message_data: the message data that should be checked for profanity
-    :return: boolean, whether the list of iterated profane terms matches the list of the terms not found in message
+    :return: boolean, whether any of the profane terms were found in the message
     :raise e: TypeError if message_data is None
     """
     if not message_data:
         raise TypeError('message_data must not be None')
 
-    profane_terms = profanity_terms.profanity
-    not_in = []
-    message = message_data['message'].replace(' ', '').lower()
-    for i in itertools.takewhile(lambda x: x not in message, profane_terms):
-        not_in.append(i)
-
-    # if the lengths of the two lists match, the term is not profane
-    return len(not_in) != len(profane_terms)
+    return automaton.search(PROFANITY, message_data['message'].replace(' ', '').lower())
 
 def length(message_data):
     """
@@ -45,13 +50,28 @@ def length(message_data):
 def parseable(message_data):
     """
     message filter that asserts the sent message is parseable. The allowed range of characters includes alphanumeric
-    and punctuation that is reasonable to expect in a text message (e.g., '|' and '\' are not included)
+    and punctuation that is reasonable to expect in a text message, plus any characters the topic adds with its
+    parseable_characters setting (e.g., accented letters or emoji). The message is checked in a single regex search
+    against a pattern compiled once per set of characters.
     :param message_data: the message data to be validated
-    :return: boolean, whether the message is parseable by the confines of acceptable characters
+    :return: boolean, whether the message contains characters outside the acceptable ones
     :raise e: TypeError if message_data is None
     """
     if not message_data:
         raise TypeError('message_data must not be None')
 
-    acceptable = range(97, 123) + range(65, 91) + range(48, 58) + range(33, 43) + range(44, 48) + [58, 63, 64, 94]
-    return any(ord(c) not in acceptable for c in message_data['message'].replace(' ', ''))
+    return parseable_pattern(config.parseable_characters(message_data['topic'])).search(message_data['message']) \
+        is not None
+
+def parseable_pattern(extra_characters=u''):
+    """
+    returns the compiled pattern that matches any character outside of the default acceptable characters and the
+    given extra characters, compiling it on first use
+    :param extra_characters: string of characters to accept in addition to the defaults
+    :return: compiled regex pattern
+    """
+    pattern = PARSEABLE_PATTERNS.get(extra_characters)
+    if pattern is None:
+        characters = u''.join(re.escape(c) for c in PARSEABLE_CHARACTERS + extra_characters)
+        pattern = PARSEABLE_PATTERNS[extra_characters] = re.compile(u'[^%s]' % characters, re.UNICODE)
+    return pattern
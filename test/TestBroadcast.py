@@ -0,0 +1,88 @@
+import time
+import unittest
+
+import pyrowire
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.messaging import broadcast
+from pyrowire.messaging import client as messages
+from test import test_settings
+from test.twilio_server import INVALID_NUMBER, StandInServer
+
+pyro.configure(test_settings)
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.numbers = ['+1503555%04d' % i for i in range(30)]
+        self.server = StandInServer().start()
+        config.twilio(self.topic)['base_url'] = self.server.url
+        messages.CLIENTS['pid'] = None
+        self.keys = ['%s.metrics' % self.topic, 'subscribers']
+
+    def tearDown(self):
+        for key in ('base_url', 'rate', 'burst', 'timeout'):
+            config.twilio(self.topic).pop(key, None)
+        self.redis.delete('twilio.rate.%s' % config.twilio(self.topic)['from_number'])
+        messages.CLIENTS['pid'] = None
+        self.server.stop()
+        self.redis.delete(*self.keys)
+
+    def broadcast(self, numbers, **kwargs):
+        counts = pyrowire.broadcast(self.topic, numbers, 'Sale!', **kwargs)
+        self.keys.append('%s.broadcast.%s' % (self.topic, counts['id']))
+        return counts
+
+    def test_broadcast(self):
+        counts = self.broadcast(iter(self.numbers + [INVALID_NUMBER]))
+        self.assertEqual((30, 1, 0), (counts['sent'], counts['failed'], counts['skipped']))
+        self.assertEqual(31, len(self.server.requests))
+        self.assertEqual(['Sale!'], self.server.requests[0][2]['Body'])
+
+        results = self.redis.hgetall('%s.broadcast.%s' % (self.topic, counts['id']))
+        self.assertEqual(31, len(results))
+        self.assertTrue(results[self.numbers[0]].startswith('SM'))
+        self.assertEqual('failed:21211', results[INVALID_NUMBER])
+        self.assertEqual('30', self.redis.hget('%s.metrics' % self.topic, 'sent'))
+        self.assertAlmostEqual(broadcast.RESULTS_TTL, self.redis.ttl('%s.broadcast.%s' % (self.topic, counts['id'])),
+                               delta=5)
+
+    def test_resume(self):
+        counts = self.broadcast(self.numbers[:10])
+        # the broadcast was cut short, and one message could not be sent; resuming sends the rest, and that one again
+        self.redis.hset('%s.broadcast.%s' % (self.topic, counts['id']), self.numbers[0], 'error:error')
+        counts = self.broadcast(self.numbers, broadcast_id=counts['id'])
+        self.assertEqual((21, 0, 9), (counts['sent'], counts['failed'], counts['skipped']))
+        self.assertEqual(31, len(self.server.requests))
+
+    def test_unknown(self):
+        # a message whose connection was reset once twilio had it may have been sent, so it is not sent again
+        self.server.reset_connections = True
+        counts = self.broadcast(self.numbers[:1])
+        self.assertEqual((0, 1), (counts['sent'], counts['failed']))
+        results = '%s.broadcast.%s' % (self.topic, counts['id'])
+        self.assertEqual('unknown:error', self.redis.hget(results, self.numbers[0]))
+        counts = self.broadcast(self.numbers[:1], broadcast_id=counts['id'])
+        self.assertEqual((0, 1), (counts['sent'], counts['skipped']))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_rate(self):
+        # a broadcast to more numbers than the rate allows within the timeout waits for the rate, rather than failing
+        config.twilio(self.topic).update({'rate': 40, 'burst': 1, 'timeout': 0.1})
+        started = time.time()
+        counts = self.broadcast(self.numbers[:10])
+        self.assertEqual((10, 0), (counts['sent'], counts['failed']))
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        self.assertEqual(10, len(self.server.requests))
+
+    def test_redis_set(self):
+        self.redis.sadd('subscribers', *self.numbers)
+        counts = self.broadcast('subscribers')
+        self.assertEqual(30, counts['sent'])
+        self.assertEqual(sorted(self.numbers), sorted(request[2]['To'][0] for request in self.server.requests))
+
+    def test_no_body(self):
+        self.assertRaises(TypeError, pyrowire.broadcast, self.topic, self.numbers)
@@ -34,3 +34,30 @@ class TestConfigurator(unittest.TestCase):
             for p in [j for j in config.properties(t).keys()]:
                 self.assertEqual(test_settings.TOPICS[t]['properties'][p], config.properties(t,p))
 
+    def test_redis_pool(self):
+        redis = config.redis_connection()
+        pool = redis.connection_pool
+
+        # one client and pool per process, shared by every caller
+        self.assertIs(redis, config.redis_connection())
+        self.assertEqual(config.redis_pool_option('max_connections'), pool.max_connections)
+        self.assertEqual(config.redis('host'), pool.connection_kwargs['host'])
+        self.assertTrue(redis.ping())
+
+    def test_validator_chain(self):
+        for topic, settings in test_settings.TOPICS.items():
+            chain = config.validator_chain(topic)
+            self.assertIsInstance(chain, tuple)
+            # only validators that are both registered and named in the topic settings, in registration order
+            self.assertEqual([v for v in config.validators().keys() if v in settings['validators']],
+                             [func.__name__ for func, error_response in chain])
+            for func, error_response in chain:
+                self.assertEqual(settings['validators'][func.__name__], error_response)
+
+        # the chain is rebuilt when a validator is added
+        def must_say_yo(message_data):
+            return 'yo' not in message_data['message']
+        config.add_validator(must_say_yo)
+        self.assertEqual((must_say_yo, test_settings.TOPICS['sample']['validators']['must_say_yo']),
+                         config.validator_chain('sample')[-1])
+        pyro.configure(test_settings)
@@ -0,0 +1,69 @@
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.errors import errors
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+def fail(message):
+    return message['sid']
+
+
+class TestErrors(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.keys = ['%s.%s' % (self.topic, key) for key in ('errors', 'error.counts', 'metrics')]
+        self.redis.delete(*self.keys)
+
+    def tearDown(self):
+        config.topics(self.topic).pop('error_log', None)
+        self.redis.delete(*self.keys)
+
+    def record(self, message):
+        try:
+            fail(message)
+        except KeyError as e:
+            return errors.error_record(e, message, 'worker')
+
+    def test_record(self):
+        record = self.record({'message': 'No sid'})
+        self.assertEqual('KeyError', record['class'])
+        self.assertEqual('worker', record['source'])
+        self.assertEqual({'message': 'No sid'}, record['message'])
+        self.assertIn('in fail', record['traceback'])
+        # the same failure gets the same signature, whatever the message
+        self.assertEqual(record['signature'], self.record({'message': 'Also no sid'})['signature'])
+        self.assertNotEqual(record['signature'], errors.error_record(KeyError('sid'))['signature'])
+
+    def test_log(self):
+        # errors in the same second no longer overwrite each other
+        for i in range(3):
+            errors.log_error(self.topic, self.record({'message': 'No sid %s' % i}), self.redis)
+        pipeline = self.redis.pipeline(transaction=True)
+        errors.log_error(self.topic, errors.error_record(TypeError('bad')), pipeline)
+        pipeline.execute()
+
+        recent = errors.recent_errors(self.topic, 3, self.redis)
+        self.assertEqual(['TypeError', 'KeyError', 'KeyError'], [record['class'] for record in recent])
+        self.assertEqual({'message': 'No sid 1'}, recent[2]['message'])
+
+        counts = errors.error_counts(self.topic, self.redis)
+        self.assertEqual(3, counts['KeyError:%s' % recent[1]['signature']])
+        self.assertEqual(1, counts['TypeError:%s' % recent[0]['signature']])
+        self.assertEqual('4', self.redis.hget('%s.%s' % (self.topic, 'metrics'), 'errors'))
+
+    def test_capped(self):
+        config.topics(self.topic)['error_log'] = {'max_length': 100}
+        record = self.record({'message': 'No sid'})
+        for i in range(1000):
+            errors.log_error(self.topic, record, self.redis)
+        self.assertLess(self.redis.xlen('%s.%s' % (self.topic, 'errors')), 1000)
+        self.assertEqual(1000, errors.error_counts(self.topic, self.redis).values()[0])
+
+if __name__ == '__main__':
+    unittest.main()
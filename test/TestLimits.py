@@ -0,0 +1,42 @@
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.limits.limits import take_token
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+class TestLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = config.redis_connection()
+        self.keys = ['test.rate.number', 'test.rate']
+        self.redis.delete(*self.keys)
+
+    def tearDown(self):
+        self.redis.delete(*self.keys)
+
+    def test_no_buckets(self):
+        self.assertEqual(0, take_token([]))
+
+    def test_burst(self):
+        buckets = [(self.keys[0], 0.5, 3)]
+        for i in range(3):
+            self.assertEqual(0, take_token(buckets))
+        # the bucket is empty, and refills at one token every two seconds
+        wait = take_token(buckets)
+        self.assertTrue(0 < wait <= 2000)
+        self.assertTrue(self.redis.pttl(self.keys[0]) > 0)
+
+    def test_all_or_nothing(self):
+        number = (self.keys[0], 0.1, 1)
+        topic = (self.keys[1], 0.1, 5)
+        self.assertEqual(0, take_token([number, topic]))
+        # the number's bucket is empty, so no token is taken from the topic's bucket either
+        self.assertTrue(take_token([number, topic]) > 0)
+        self.assertEqual(4, int(float(self.redis.hget(self.keys[1], 'tokens'))))
+
+if __name__ == '__main__':
+    unittest.main()
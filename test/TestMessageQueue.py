@@ -21,6 +21,11 @@ class TestMessageQueue(unittest.TestCase):
         self.redis = Redis(config.redis('host'), int(config.redis('port')), int(config.redis('db')), config.redis('password'))
 
     def tearDown(self):
+        config.topics(self.topic).pop('rate_limit', None)
+        config.topics(self.topic).pop('backpressure', None)
+        self.redis.delete('%s.metrics' % self.topic)
+        for key in self.redis.keys('%s.rate*' % self.topic):
+            self.redis.delete(key)
         self.redis.delete('%s.submitted' % self.topic)
         self.redis.delete('%s.pending' % self.topic)
         self.redis.delete('%s.completed' % self.topic)
@@ -105,6 +110,79 @@ class TestMessageQueue(unittest.TestCase):
         self.assertEqual(data, expected_response)
 
 
+    def test_duplicate_message(self):
+        expected_response = config.accept_response(self.topic)
+        first = self.test_app.get(self.inbound % (self.topic, 'Hello there.', self.sid, 0), follow_redirects=True)
+        # a retry of the same message, even with a different body, is answered the same way and not queued again
+        retry = self.test_app.get(self.inbound % (self.topic, 'fuck', self.sid, 0), follow_redirects=True)
+
+        data = str(retry.data).split('<Body>')[1].split('</Body>')[0]
+
+        self.assertEqual(retry.status, "200 OK")
+        self.assertEqual(data, expected_response)
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(1, self.redis.llen('%s.submitted' % self.topic))
+
+        # without the local cache, the response comes from redis
+        from pyrowire.routes import queue_message
+        queue_message.RECENT_RESPONSES.clear()
+        retry = self.test_app.get(self.inbound % (self.topic, 'fuck', self.sid, 0), follow_redirects=True)
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(1, self.redis.llen('%s.submitted' % self.topic))
+
+    def test_throttled_message(self):
+        config.topics(self.topic)['rate_limit'] = {'number': {'rate': 0.01, 'burst': 2}, 'response': 'Slow down.'}
+        for i in range(3):
+            sid = ''.join(random.choice(string.ascii_letters) for i in range(34))
+            response = self.test_app.get(self.inbound % (self.topic, 'Hello there.', sid, 0), follow_redirects=True)
+            data = str(response.data).split('<Body>')[1].split('</Body>')[0]
+            self.assertEqual(response.status, "200 OK")
+        # the third message is over the sender's burst, and is not queued
+        self.assertEqual(data, 'Slow down.')
+        self.assertEqual(2, self.redis.llen('%s.submitted' % self.topic))
+
+    def test_busy_message(self):
+        config.topics(self.topic)['backpressure'] = {'max_queue_depth': 2, 'response': 'Busy.'}
+        for i in range(4):
+            sid = ''.join(random.choice(string.ascii_letters) for i in range(34))
+            response = self.test_app.get(self.inbound % (self.topic, 'Hello there.', sid, 0), follow_redirects=True)
+            data = str(response.data).split('<Body>')[1].split('</Body>')[0]
+            self.assertEqual(response.status, "200 OK")
+        # the queue was full for the last two messages
+        self.assertEqual(data, 'Busy.')
+        self.assertEqual(2, self.redis.llen('%s.submitted' % self.topic))
+        self.assertEqual('2', self.redis.hget('%s.metrics' % self.topic, 'busy'))
+        self.assertEqual('2', self.redis.hget('%s.metrics' % self.topic, 'accepted'))
+
+    def test_twiml_response(self):
+        from pyrowire.messaging import responses
+        response = self.test_app.get(self.inbound % (self.topic, 'Hello there.', self.sid, 0), follow_redirects=True)
+
+        self.assertEqual('text/xml', response.mimetype)
+        self.assertEqual(responses.render(config.accept_response(self.topic)), response.data)
+        # static replies are rendered once; dynamic ones are escaped the same way, but not cached
+        self.assertTrue(config.error_response(self.topic) in responses.RESPONSES)
+        self.assertTrue('<Body>Fish &amp; chips &lt;3</Body>' in responses.dynamic('Fish & chips <3'))
+        self.assertFalse('Fish & chips <3' in responses.RESPONSES)
+        self.assertFalse('<Message>' in responses.render())
+
+    def test_send_on_accept(self):
+        from pyrowire.messaging import responses
+        from pyrowire.routes import queue_message
+        sent = []
+        send_reply = queue_message.send_reply
+        queue_message.send_reply = lambda message_data, key='reply': sent.append(message_data[key])
+        config.topics(self.topic)['send_on_accept'] = True
+        try:
+            response = self.test_app.get(self.inbound % (self.topic, 'Hello there.', self.sid, 0),
+                                         follow_redirects=True)
+        finally:
+            config.topics(self.topic)['send_on_accept'] = False
+            queue_message.send_reply = send_reply
+        # the accept message is sent through the reply executor, and so is left out of the twiml response
+        self.assertEqual([config.accept_response(self.topic)], sent)
+        self.assertEqual(responses.render(), response.data)
+
     def test_message_construction(self):
         # no additional args
         class Request(object):
@@ -0,0 +1,157 @@
+import base64
+import socket
+import threading
+import time
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.messaging import client as messages
+from pyrowire.messaging.send import async_mms, async_sms, mms, sms
+from test import test_settings
+from test.twilio_server import INVALID_NUMBER, StandInServer
+
+pyro.configure(test_settings)
+
+
+class TestMessagesClient(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer().start()
+        config.twilio('sample')['base_url'] = self.server.url
+        messages.CLIENTS['pid'] = None
+
+    def tearDown(self):
+        for key in ('base_url', 'rate', 'burst'):
+            config.twilio('sample').pop(key, None)
+        config.redis_connection().delete('twilio.rate.%s' % config.twilio('sample')['from_number'])
+        messages.CLIENTS['pid'] = None
+        self.server.stop()
+
+    def test_sms(self):
+        for i in range(3):
+            self.assertTrue(sms({'reply': 'Test %s' % i, 'number': '+15039280913', 'topic': 'sample'}))
+
+        self.assertEqual(len(self.server.requests), 3)
+        path, authorization, form = self.server.requests[-1]
+        self.assertEqual(path, '/2010-04-01/Accounts/%s/Messages.json' % config.twilio('sample')['account_sid'])
+        self.assertEqual(authorization, 'Basic %s' % base64.b64encode('%s:%s' % (
+            config.twilio('sample')['account_sid'], config.twilio('sample')['auth_token'])))
+        self.assertEqual(form, {'To': ['+15039280913'], 'From': ['+1234567890'], 'Body': ['Test 2']})
+        # every message went out on the one keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    def test_mms(self):
+        job_data = {'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}
+        self.assertFalse(mms(job_data))
+        self.assertTrue(mms(job_data, include_text=True, media_url='http://example.com/cat.gif'))
+        self.assertTrue(mms(job_data, media_url='http://example.com/cat.gif'))
+
+        self.assertEqual(self.server.requests[0][2]['Body'], ['Test'])
+        self.assertEqual(self.server.requests[0][2]['MediaUrl'], ['http://example.com/cat.gif'])
+        self.assertNotIn('Body', self.server.requests[1][2])
+
+    def test_turned_down(self):
+        self.assertFalse(sms({'reply': 'Test', 'number': INVALID_NUMBER, 'topic': 'sample'}))
+        with self.assertRaises(messages.TwilioError) as context:
+            messages.client('sample').create(to=INVALID_NUMBER, body='Test')
+        self.assertEqual((context.exception.status, context.exception.code), (400, 21211))
+        # an error response leaves the connection open for the next message
+        self.assertTrue(sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_cached_client(self):
+        cached = messages.client('sample')
+        self.assertIs(messages.client('sample'), cached)
+        # a forked process builds clients of its own
+        messages.CLIENTS['pid'] = None
+        self.assertIsNot(messages.client('sample'), cached)
+
+    def test_reconnect(self):
+        self.server.drop_connections = True
+        for i in range(3):
+            self.assertTrue(sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_no_resend(self):
+        self.assertTrue(sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}))
+        # a message the api may have accepted on a reused connection is not sent again when the connection is reset
+        self.server.reset_connections = True
+        self.assertFalse(sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_delivery(self):
+        # a message twilio turned down, or that could not be read, fails for good
+        with self.assertRaises(messages.TwilioError) as context:
+            messages.client('sample').create(to=INVALID_NUMBER, body='Test')
+        self.assertEqual('failed', messages.delivery(context.exception))
+        self.assertEqual('failed', messages.delivery(KeyError('number')))
+        # one that twilio was too busy for, or never got, may be sent again
+        self.server.busy = 1
+        with self.assertRaises(messages.TwilioError) as context:
+            messages.client('sample').create(to='+15039280913', body='Test')
+        self.assertEqual('error', messages.delivery(context.exception))
+        with self.assertRaises(socket.error) as context:
+            messages.MessagesClient('', '', '+1234567890', base_url='http://127.0.0.1:1').create(to='+15039280913')
+        self.assertEqual('error', messages.delivery(context.exception))
+        # one whose connection was reset once it was sent may have been created
+        self.server.reset_connections = True
+        with self.assertRaises(socket.error) as context:
+            messages.client('sample').create(to='+15039280913', body='Test')
+        self.assertEqual('unknown', messages.delivery(context.exception))
+
+    def test_rate(self):
+        config.twilio('sample').update({'rate': 10, 'burst': 2})
+        config.redis_connection().delete('twilio.rate.%s' % config.twilio('sample')['from_number'])
+        started = time.time()
+        for i in range(5):
+            self.assertTrue(sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}))
+        # two go out at once, then one every tenth of a second
+        self.assertGreaterEqual(time.time() - started, 0.25)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertAlmostEqual(messages.client('sample').shape(), 0.1, delta=0.02)
+
+    def test_async_sms(self):
+        self.server.delay = 0.02
+        started = time.time()
+        futures = [async_sms({'reply': 'Test %s' % i, 'number': '+15039280913', 'topic': 'sample'}) for i in range(200)]
+        self.assertTrue(all(future.result(10)['sid'].startswith('SM') for future in futures))
+        # sent on the client's four keep-alive connections at once, rather than one after another
+        self.assertLess(time.time() - started, 200 * 0.02 / 2)
+        self.assertEqual(len(self.server.requests), 200)
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_async_timeout(self):
+        self.server.delay = 0.5
+        future = async_sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}, timeout=0.1)
+        self.assertIsInstance(future.exception(5), socket.timeout)
+        self.assertRaises(socket.timeout, future.result)
+
+    def test_async_failed(self):
+        done = []
+        future = async_sms({'number': '+15039280913', 'topic': 'sample'}, callback=done.append)
+        self.assertIsInstance(future.exception(), KeyError)
+        future = async_mms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}, callback=done.append)
+        self.assertIsInstance(future.exception(), TypeError)
+        future = async_sms({'reply': 'Test', 'number': INVALID_NUMBER, 'topic': 'sample'}, callback=done.append)
+        self.assertEqual(21211, future.exception(5).code)
+        # a message with no number fails too, rather than raising at the call
+        future = async_mms({'topic': 'sample'}, media_url='http://example.com/cat.gif', callback=done.append)
+        self.assertIsInstance(future.exception(), KeyError)
+        self.assertIsInstance(async_sms({'reply': 'Test', 'topic': 'sample'}).exception(), KeyError)
+        self.assertEqual(4, len(done))
+
+    def test_async_callback(self):
+        recorded, started = [], threading.Event()
+
+        def record(future):
+            started.set()
+            # a callback may look at its own future without waiting on itself
+            time.sleep(0.1)
+            recorded.append(future.result()['sid'])
+
+        future = async_sms({'reply': 'Test', 'number': '+15039280913', 'topic': 'sample'}, callback=record)
+        started.wait(5)
+        # the result is only handed to other threads once the callback is done
+        self.assertEqual([future.result(5)['sid']], recorded)
@@ -0,0 +1,151 @@
+import json
+import logging
+import time
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.errors.errors import recent_errors
+from pyrowire.messaging import client as messages
+from pyrowire.messaging import outbound
+from pyrowire.messaging.send import mms, sms
+from pyrowire.queues.queues import STALE_AFTER
+from test import test_settings
+from test.twilio_server import INVALID_NUMBER, StandInServer
+
+pyro.configure(test_settings)
+
+
+class TestOutbound(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.queue = outbound.outbound_queue(self.topic)
+        self.keys = [self.queue.key, self.queue.processing(), self.queue.processing('dead:1'), self.queue.workers,
+                     self.queue.retries] + \
+                    ['%s.%s' % (self.topic, key) for key in ('sent', 'sent.index', 'metrics', 'errors', 'error.counts')]
+        self.redis.delete(*self.keys)
+        self.server = StandInServer().start()
+        config.twilio(self.topic)['base_url'] = self.server.url
+        config.topics(self.topic)['outbound'] = {'queue': True, 'concurrency': 4}
+        messages.CLIENTS['pid'] = None
+
+    def tearDown(self):
+        for key in ('base_url', 'rate', 'burst', 'timeout'):
+            config.twilio(self.topic).pop(key, None)
+        self.redis.delete('twilio.rate.%s' % config.twilio(self.topic)['from_number'])
+        config.topics(self.topic).pop('outbound')
+        config.topics(self.topic).pop('retention', None)
+        messages.CLIENTS['pid'] = None
+        self.server.stop()
+        self.redis.delete(*self.keys)
+
+    def message(self, number='+15039280913'):
+        return {'message': 'Test', 'reply': 'TestTestTest', 'number': number, 'topic': self.topic}
+
+    def test_queued(self):
+        self.assertTrue(sms(self.message()))
+        self.assertTrue(mms(self.message(), media_url='http://example.com/cat.gif'))
+        # a message with nothing to send is turned down now, rather than by the sender
+        self.assertFalse(sms(self.message(), key='missing'))
+        self.assertTrue(sms(self.message(), queue=False))
+
+        queued = [json.loads(job) for job in self.redis.lrange(self.queue.key, 0, -1)]
+        self.assertEqual(2, len(queued))
+        self.assertEqual('reply', queued[0]['key'])
+        self.assertEqual((None, 'http://example.com/cat.gif'), (queued[1]['key'], queued[1]['media_url']))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_send_outbound(self):
+        config.topics(self.topic)['retention'] = {'max_entries': 100}
+        ids = [outbound.enqueue(self.message()) for i in range(10)]
+        failed = outbound.enqueue(self.message(INVALID_NUMBER))
+        self.assertTrue(mms(self.message(), include_text=True, media_url='http://example.com/cat.gif'))
+
+        self.assertEqual(12, outbound.send_outbound([self.topic], persist=False))
+        self.assertEqual(12, len(self.server.requests))
+        self.assertEqual(0, self.redis.llen(self.queue.key))
+        self.assertEqual(0, self.redis.llen(self.queue.processing()))
+
+        result = json.loads(self.redis.hget('%s.sent' % self.topic, ids[0]))
+        self.assertEqual(('sent', '+15039280913'), (result['status'], result['number']))
+        self.assertTrue(result['sid'].startswith('SM'))
+        result = json.loads(self.redis.hget('%s.sent' % self.topic, failed))
+        self.assertEqual('failed', result['status'])
+        self.assertEqual(12, self.redis.zcard('%s.sent.index' % self.topic))
+
+        metrics = self.redis.hgetall('%s.metrics' % self.topic)
+        self.assertEqual(('11', '1'), (metrics['sent'], metrics['send_failed']))
+        self.assertEqual('sender', recent_errors(self.topic, 1, self.redis)[0]['source'])
+
+    def test_send_outbound_rate(self):
+        # more messages than the rate allows within the timeout wait their turn, and are all sent
+        config.twilio(self.topic).update({'rate': 40, 'burst': 1, 'timeout': 0.1})
+        ids = [outbound.enqueue(self.message()) for i in range(10)]
+
+        self.assertEqual(10, outbound.send_outbound([self.topic], persist=False))
+        self.assertEqual(10, len(self.server.requests))
+        self.assertEqual(['sent'] * 10, [json.loads(result)['status']
+                                         for result in self.redis.hmget('%s.sent' % self.topic, ids)])
+
+    def test_retry(self):
+        backoff, outbound.RETRY_BACKOFF = outbound.RETRY_BACKOFF, 0
+        try:
+            # a message twilio was too busy for is sent again, until it is sent
+            self.server.busy = 2
+            sent = outbound.enqueue(self.message())
+            self.assertEqual(1, outbound.send_outbound([self.topic], persist=False))
+            self.assertEqual(3, len(self.server.requests))
+            self.assertEqual('sent', json.loads(self.redis.hget('%s.sent' % self.topic, sent))['status'])
+
+            # or until it has been tried max_attempts times
+            config.topics(self.topic)['outbound']['max_attempts'] = 2
+            self.server.busy = 5
+            failed = outbound.enqueue(self.message())
+            self.assertEqual(1, outbound.send_outbound([self.topic], persist=False))
+            self.assertEqual(5, len(self.server.requests))
+            self.assertEqual('failed', json.loads(self.redis.hget('%s.sent' % self.topic, failed))['status'])
+        finally:
+            outbound.RETRY_BACKOFF = backoff
+        self.assertEqual(0, self.redis.zcard(self.queue.retries))
+
+        # a message that is not due yet waits in the retry set
+        job = json.dumps({'id': 'later', 'message_data': self.message(), 'key': 'reply', 'attempts': 1})
+        self.redis.zadd(self.queue.retries, {job: time.time() + 60})
+        self.assertEqual(0, self.queue.due(self.redis))
+        self.redis.zadd(self.queue.retries, {job: time.time()})
+        self.assertEqual(1, self.queue.due(self.redis))
+        self.assertEqual([job], self.redis.lrange(self.queue.key, 0, -1))
+
+    def test_record_failure(self):
+        outbound.enqueue(self.message(INVALID_NUMBER))
+        sender = outbound.OutboundSender(self.topic, self.redis, logging.getLogger(__name__))
+        log_error = outbound.log_error
+
+        def unavailable(*args):
+            raise outbound.ConnectionError('redis went away')
+
+        # a message whose result redis could not take is handed back to the head of the queue, not left in flight
+        job_id, raw_job = self.queue.fetch(1, self.redis, block=False)[0]
+        outbound.log_error = unavailable
+        try:
+            sender.record(job_id, raw_job, json.loads(raw_job), None, messages.TwilioError(400, 21211))
+        finally:
+            outbound.log_error = log_error
+        self.assertEqual(0, self.redis.llen(self.queue.processing()))
+        self.assertEqual([raw_job], self.redis.lrange(self.queue.key, 0, -1))
+
+        # a message whose result cannot be recorded at all is acknowledged, rather than handed back to be sent again
+        job_id, raw_job = self.queue.fetch(1, self.redis, block=False)[0]
+        sender.record(job_id, raw_job, json.loads(raw_job), object(), None)
+        self.assertEqual(0, self.redis.llen(self.queue.processing()))
+        self.assertEqual(0, self.redis.llen(self.queue.key))
+
+    def test_reap(self):
+        # a sender that died while sending has its messages re-queued
+        self.redis.rpush(self.queue.processing('dead:1'), json.dumps({'message_data': self.message(), 'key': 'reply'}))
+        self.redis.hset(self.queue.workers, 'dead:1', time.time() - STALE_AFTER - 1)
+        self.assertEqual(1, self.queue.reap(self.redis))
+        self.assertEqual(1, self.redis.llen(self.queue.key))
+        self.assertEqual(1, outbound.send_outbound([self.topic], persist=False))
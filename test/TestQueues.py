@@ -0,0 +1,161 @@
+import json
+import random
+import string
+import threading
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+import pyrowire.queues.queues as queues
+import pyrowire.tasks.tasks as tasks
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+class TestQueues(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.test_app = config.app().test_client()
+        self.inbound = '/queue/%s?Body=%s&From=+1234567890&MessageSid=%s&NumMedia=0'
+        self.stream = '%s.%s' % (self.topic, 'stream')
+        self.redis.delete(self.stream)
+
+    def tearDown(self):
+        config.topics(self.topic).pop('queue', None)
+        config.topics(self.topic).pop('shared', None)
+        config.topics().pop('other', None)
+        self.redis.delete(self.stream, '%s.workers' % self.topic, '%s.submitted' % self.topic, 'other.submitted',
+                          queues.processing_list('other'), queues.processing_list(self.topic),
+                          queues.wake_key(self.topic), queues.wake_key('other'))
+
+    def sid(self):
+        return ''.join(random.choice(string.ascii_letters) for i in range(34))
+
+    def use_streams(self, **settings):
+        settings['backend'] = 'stream'
+        config.topics(self.topic)['queue'] = settings
+
+    def test_default_backend(self):
+        self.assertEqual('list', queues.backend(self.topic).kind)
+        self.assertEqual('%s.%s' % (self.topic, 'submitted'), queues.backend(self.topic).key)
+
+    def test_stream(self):
+        self.use_streams()
+        sid = self.sid()
+        self.test_app.get(self.inbound % (self.topic, 'Stream%20me', sid), follow_redirects=True)
+        # the ingest script adds the message to the topic's stream, rather than its list
+        self.assertEqual(1, self.redis.xlen(self.stream))
+        self.assertEqual(0, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+
+        handler = config.topics(self.topic).get('handler')
+        config.add_handler(self.topic, lambda message_data: message_data)
+        try:
+            self.assertEqual(sid, tasks.process_queue_item(self.topic, persist=False))
+        finally:
+            config.add_handler(self.topic, handler)
+        self.assertTrue(self.redis.hexists('%s.%s' % (self.topic, 'complete'), sid))
+        # once acknowledged, the job is no longer pending, and is gone from the stream
+        self.assertEqual(0, self.redis.xpending(self.stream, queues.GROUP)['pending'])
+        self.assertEqual(0, self.redis.xlen(self.stream))
+
+    def test_stream_claim(self):
+        self.use_streams(claim_after=0)
+        queue = queues.backend(self.topic)
+        queues.create_group(self.stream, self.redis)
+        job = json.dumps({'message': 'Claim me', 'number': '+1234567890', 'sid': self.sid(), 'topic': self.topic})
+        entry_id = self.redis.xadd(self.stream, {'job': job})
+        # a consumer takes the job, then dies without acknowledging it
+        self.redis.xreadgroup(queues.GROUP, 'dead-host:1', {self.stream: '>'})
+
+        self.assertEqual(1, queue.reap(self.redis))
+        self.assertEqual([(entry_id, job)], queue.fetch(10, self.redis))
+        pending = self.redis.xpending_range(self.stream, queues.GROUP, '-', '+', 10)
+        self.assertEqual(queues.worker_id(), pending[0]['consumer'])
+
+    def test_stream_depth(self):
+        # the stream only holds jobs still to be handled, so it is bounded by backpressure, rather than trimmed
+        self.use_streams()
+        config.topics(self.topic)['backpressure'] = {'max_queue_depth': 100, 'response': 'Busy.'}
+        try:
+            for i in range(150):
+                self.test_app.get(self.inbound % (self.topic, 'Queue%20me', self.sid()), follow_redirects=True)
+        finally:
+            config.topics(self.topic).pop('backpressure')
+        self.assertEqual(100, self.redis.xlen(self.stream))
+        self.assertEqual('50', self.redis.hget('%s.metrics' % self.topic, 'busy'))
+        self.redis.delete('%s.metrics' % self.topic)
+
+    def test_stream_claim_deleted(self):
+        self.use_streams(claim_after=0)
+        queues.create_group(self.stream, self.redis)
+        entry_id = self.redis.xadd(self.stream, {'job': 'gone'})
+        self.redis.xreadgroup(queues.GROUP, 'dead-host:1', {self.stream: '>'})
+        self.redis.xdel(self.stream, entry_id)
+        # an entry deleted while pending is acknowledged when claimed, rather than claimed again on every reap
+        self.assertEqual(0, queues.backend(self.topic).reap(self.redis))
+        self.assertEqual(0, self.redis.xpending(self.stream, queues.GROUP)['pending'])
+
+    def test_fair_fetch(self):
+        config.topics()['other'] = dict(config.topics(self.topic))
+        for topic, count in [(self.topic, 5), ('other', 2)]:
+            self.redis.rpush('%s.%s' % (topic, 'submitted'), *['%s-%s' % (topic, i) for i in range(count)])
+
+        # each topic gives up to its quota, in the order served, until the limit is reached
+        jobs = queues.fetch_fair([self.topic, 'other'], [3, 3], 4, self.redis)
+        self.assertEqual([self.topic, self.topic, self.topic, 'other'], [topic for topic, job in jobs])
+        self.assertEqual(['sample-0', 'sample-1', 'sample-2', 'other-0'], [job[1] for topic, job in jobs])
+        jobs = queues.fetch_fair(['other', self.topic], [3, 1], 10, self.redis)
+        self.assertEqual([('other', ('other-1', 'other-1')), (self.topic, ('sample-3', 'sample-3'))], jobs)
+        self.assertEqual(['other-0', 'other-1'], self.redis.lrange(queues.processing_list('other'), 0, -1))
+
+        # with every queue but one empty, the worker blocks until a job arrives on it
+        self.redis.rpush('other.submitted', 'other-2')
+        self.assertEqual([('other', ('other-2', 'other-2'))], queues.wait_for_job(['other'], self.redis))
+        self.assertEqual('other-2', self.redis.lindex(queues.processing_list('other'), -1))
+
+    def test_wait_for_job(self):
+        config.topics()['other'] = dict(config.topics(self.topic))
+        config.topics(self.topic)['shared'] = True
+        # a message queued while the worker waits on many lists wakes it, and is moved straight to its processing list
+        timer = threading.Timer(0.15, self.test_app.get, (self.inbound % (self.topic, 'Wake%20me', self.sid()),))
+        timer.start()
+        try:
+            jobs = queues.wait_for_job(['other', self.topic], self.redis)
+        finally:
+            timer.join()
+        self.assertEqual([self.topic], [topic for topic, job in jobs])
+        self.assertEqual([jobs[0][1][1]], self.redis.lrange(queues.processing_list(self.topic), 0, -1))
+        self.assertEqual(0, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+
+        # the wake list keeps a bounded number of tokens; one left over from a job already taken finds nothing
+        for i in range(queues.WAKE_TOKENS + 1):
+            self.test_app.get(self.inbound % (self.topic, 'Wake%20me', self.sid()))
+        self.assertEqual(queues.WAKE_TOKENS, self.redis.llen(queues.wake_key(self.topic)))
+        self.redis.delete('%s.%s' % (self.topic, 'submitted'))
+        self.assertEqual([], queues.wait_for_job(['other', self.topic], self.redis))
+        # with nothing arriving, it gives up after BLOCK_TIMEOUT seconds
+        self.redis.delete(queues.wake_key(self.topic), '%s.metrics' % self.topic)
+        self.assertEqual([], queues.wait_for_job(['other', self.topic], self.redis))
+
+    def test_fair_fetch_mixed(self):
+        config.topics()['other'] = dict(config.topics(self.topic))
+        self.use_streams()
+        queues.create_group(self.stream, self.redis)
+        for i in range(3):
+            self.redis.xadd(self.stream, {'job': 'sample-%s' % i})
+        self.redis.rpush('other.submitted', 'other-0', 'other-1')
+
+        jobs = queues.fetch_fair(['other', self.topic], [1, 2], 10, self.redis)
+        self.assertEqual(['other-0', 'sample-0', 'sample-1'], [job[1] for topic, job in jobs])
+        # with the list empty, the worker waits on both kinds of backend, until a job queued for either wakes it
+        self.redis.delete('other.submitted')
+        self.redis.lpush(queues.wake_key(self.topic), 1)
+        jobs = queues.wait_for_job([self.topic, 'other'], self.redis)
+        self.assertEqual([self.topic], [topic for topic, job in jobs])
+        self.assertEqual('sample-2', jobs[0][1][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+import pyrowire.messaging.replies as replies
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+class TestReplies(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.message = {'message': 'Test', 'reply': 'TestTestTest', 'number': '+1234567890', 'topic': self.topic}
+        self.redis.delete('%s.outbound' % self.topic, '%s.replies' % self.topic)
+
+    def tearDown(self):
+        config.PYROWIRE['profile'].pop('replies', None)
+        replies.EXECUTOR['pid'] = None
+        self.redis.delete('%s.outbound' % self.topic, '%s.replies' % self.topic)
+
+    def use_executor(self, **settings):
+        # no sender threads, so the queue fills up deterministically
+        settings['workers'] = 0
+        config.PYROWIRE['profile']['replies'] = settings
+        replies.EXECUTOR['pid'] = None
+
+    def test_no_message(self):
+        self.assertRaises(TypeError, replies.send_reply, None)
+
+    def test_overflow_drop(self):
+        self.use_executor(max_queue=1, overflow='drop')
+        self.assertTrue(replies.send_reply(self.message))
+        self.assertFalse(replies.send_reply(self.message))
+        self.assertEqual(1, replies.reply_queue().qsize())
+        self.assertEqual(0, self.redis.llen('%s.outbound' % self.topic))
+
+    def test_overflow_block(self):
+        self.use_executor(max_queue=1, overflow='block', block_timeout=0.01)
+        self.assertTrue(replies.send_reply(self.message))
+        self.assertFalse(replies.send_reply(self.message))
+
+    def test_overflow_redis(self):
+        self.use_executor(max_queue=1, overflow='redis')
+        self.assertTrue(replies.send_reply(self.message))
+        self.assertTrue(replies.send_reply(self.message, key='message'))
+        self.assertEqual(1, self.redis.llen('%s.replies' % self.topic))
+        # spilled replies are kept apart from the messages waiting for the topic's sender workers
+        self.assertEqual(0, self.redis.llen('%s.outbound' % self.topic))
+
+        spilled = replies.spilled_reply()
+        self.assertEqual('message', spilled['key'])
+        self.assertEqual(self.message['number'], spilled['message_data']['number'])
+        self.assertIsNone(replies.spilled_reply())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import time
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.retention import retention
+import pyrowire.tasks.tasks as tasks
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.complete = '%s.%s' % (self.topic, 'complete')
+        self.index = '%s.%s' % (self.topic, 'complete.index')
+        self.redis.delete(self.complete, self.index, '%s.compaction' % self.topic)
+
+    def tearDown(self):
+        config.topics(self.topic).pop('retention', None)
+        self.redis.delete(self.complete, self.index, '%s.compaction' % self.topic)
+
+    def write(self, count, now):
+        # entries as workers write them: one in the hash, and its time in the index
+        for i in range(count):
+            self.redis.hset(self.complete, 'SM%s' % i, json.dumps({'sid': 'SM%s' % i}))
+            self.redis.zadd(self.index, {'SM%s' % i: now + i})
+
+    def test_complete_jobs_indexed(self):
+        # only a topic with retention indexes the entries it writes
+        tasks.complete_jobs(self.topic, [('raw', 'SM0', {'sid': 'SM0'})], [], self.redis)
+        self.assertTrue(self.redis.hexists(self.complete, 'SM0'))
+        self.assertEqual(0, self.redis.zcard(self.index))
+        config.topics(self.topic)['retention'] = {'max_entries': 10}
+        tasks.complete_jobs(self.topic, [('raw', 'SM1', {'sid': 'SM1'})], [], self.redis)
+        self.assertTrue(self.redis.hexists(self.complete, 'SM1'))
+        self.assertIsNotNone(self.redis.zscore(self.index, 'SM1'))
+
+    def test_max_entries(self):
+        config.topics(self.topic)['retention'] = {'max_entries': 10, 'chunk': 4}
+        self.write(25, 1000)
+        self.assertEqual(15, retention.compact(self.topic, self.redis, now=2000))
+        # the newest entries are kept
+        self.assertEqual(10, self.redis.hlen(self.complete))
+        self.assertEqual(10, self.redis.zcard(self.index))
+        self.assertFalse(self.redis.hexists(self.complete, 'SM14'))
+        self.assertTrue(self.redis.hexists(self.complete, 'SM15'))
+
+    def test_max_age(self):
+        config.topics(self.topic)['retention'] = {'max_age': 10, 'max_entries': 12, 'chunk': 3}
+        self.write(20, 1000)
+        # older than 1005 goes by age, and the two oldest left beyond max_entries by count
+        self.assertEqual(5 + 3, retention.compact(self.topic, self.redis, now=1015))
+        self.assertEqual(['SM%s' % i for i in range(8, 20)], self.redis.zrange(self.index, 0, -1))
+
+    def test_unindexed(self):
+        config.topics(self.topic)['retention'] = {'max_entries': 5}
+        self.write(5, time.time())
+        self.redis.hset(self.complete, 'old', '{}')
+        # entries written before retention was set up are indexed as the oldest, and go first
+        self.assertEqual(1, retention.compact(self.topic, self.redis))
+        self.assertFalse(self.redis.hexists(self.complete, 'old'))
+        self.assertEqual(5, self.redis.hlen(self.complete))
+
+    def test_error_log(self):
+        config.topics(self.topic)['retention'] = {'max_entries': 100}
+        errors = '%s.%s' % (self.topic, 'errors')
+        self.redis.delete(errors)
+        for i in range(1000):
+            self.redis.xadd(errors, {'record': '{}'})
+        try:
+            self.assertGreater(retention.compact(self.topic, self.redis), 0)
+            # trimming is approximate, but never below max_entries
+            self.assertLess(self.redis.xlen(errors), 1000)
+            self.assertGreaterEqual(self.redis.xlen(errors), 100)
+        finally:
+            self.redis.delete(errors)
+
+    def test_compactor_lock(self):
+        config.topics(self.topic)['retention'] = {'max_entries': 5}
+        self.write(10, time.time())
+        compactor = retention.Compactor([self.topic])
+        self.assertEqual([self.topic], compactor.topics)
+        self.assertEqual(5, compactor.compact(self.topic))
+        # another compactor, on this host or another, leaves the topic alone until the interval is up
+        self.write(10, time.time())
+        self.assertIsNone(retention.Compactor([self.topic]).compact(self.topic))
+        self.assertEqual(10, self.redis.hlen(self.complete))
+
+if __name__ == '__main__':
+    unittest.main()
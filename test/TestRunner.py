@@ -0,0 +1,147 @@
+import json
+import os
+import signal
+import time
+import unittest
+from multiprocessing import Process
+
+from pyrowire import pyrowire
+import pyrowire.config.configuration as config
+import pyrowire.runner.runner as runner
+from test import test_settings
+
+
+pyrowire.configure(test_settings)
+
+
+class TestRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+        self.redis = config.redis_connection()
+        self.workers = '%s.%s' % (self.topic, 'workers')
+        self.redis.delete(self.workers)
+        config.topics(self.topic)['workers'] = 2
+
+    def tearDown(self):
+        config.topics(self.topic).pop('workers')
+        self.redis.delete(self.workers)
+        for key in self.redis.keys('%s.processing.*' % self.topic):
+            self.redis.delete(key)
+
+    def worker_pids(self, timeout=5, exclude=()):
+        # waits for the supervised workers' heartbeats, and returns their pids
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            pids = set(int(w.split(':')[-1]) for w in self.redis.hkeys(self.workers)) - set(exclude)
+            if len(pids) >= config.workers(self.topic):
+                return pids
+            time.sleep(0.05)
+        self.fail('workers did not start')
+
+    def test_supervise(self):
+        supervisor = Process(target=runner.supervise, kwargs={'topics': [self.topic]})
+        supervisor.start()
+        try:
+            pids = self.worker_pids()
+            self.assertEqual(2, len(pids))
+
+            # a worker that dies is restarted
+            dead = pids.pop()
+            os.kill(dead, signal.SIGKILL)
+            self.redis.hdel(self.workers, [w for w in self.redis.hkeys(self.workers) if w.endswith(':%s' % dead)][0])
+            restarted = self.worker_pids(timeout=runner.RESTART_BACKOFF + 5, exclude=[dead])
+            self.assertIn(pids.pop(), restarted)
+
+            # on SIGTERM, the workers sign off and everything exits cleanly
+            os.kill(supervisor.pid, signal.SIGTERM)
+            supervisor.join(runner.SHUTDOWN_TIMEOUT)
+            self.assertEqual(0, supervisor.exitcode)
+            self.assertEqual(0, self.redis.hlen(self.workers))
+        finally:
+            if supervisor.is_alive():
+                os.kill(supervisor.pid, signal.SIGKILL)
+
+    def test_shared_worker(self):
+        # topics that set shared share one worker; the others, whether they set workers or not, get their own
+        config.topics()['other'] = dict(config.topics(self.topic), shared=True)
+        config.topics()['third'] = dict(config.topics(self.topic), shared=True)
+        config.topics()['fourth'] = dict(config.topics(self.topic))
+        config.topics('fourth').pop('workers')
+        try:
+            supervisor = runner.Supervisor([self.topic, 'other', 'third', 'fourth'])
+            self.assertEqual([self.topic, 'fourth', ('other', 'third')], supervisor.topics)
+            self.assertEqual(2, supervisor.target(self.topic))
+            self.assertEqual(1, supervisor.target('fourth'))
+            self.assertEqual(1, supervisor.target(('other', 'third')))
+            self.assertEqual(['other'], runner.Supervisor(['other']).topics)
+        finally:
+            config.topics().pop('other')
+            config.topics().pop('third')
+            config.topics().pop('fourth')
+
+    def test_backoff(self):
+        supervisor = runner.Supervisor([self.topic])
+        slot = (self.topic, 0)
+        delays = []
+        for i in range(8):
+            supervisor.processes[slot], supervisor.started[slot] = Process(), 100
+            supervisor.exited(slot, 100)
+            delays.append(supervisor.not_before[slot] - 100)
+        self.assertEqual([1, 2, 4, 8, 16, 32, 60, 60], delays)
+
+        # a worker that ran for a while before exiting starts over
+        supervisor.processes[slot], supervisor.started[slot] = Process(), 100
+        supervisor.exited(slot, 100 + runner.STABLE_AFTER)
+        self.assertEqual(runner.RESTART_BACKOFF, supervisor.not_before[slot] - 100 - runner.STABLE_AFTER)
+
+    def test_autoscale(self):
+        config.topics(self.topic)['autoscale'] = {'min_workers': 1, 'max_workers': 10, 'scale_up_backlog': 10,
+                                                  'scale_down_backlog': 1, 'cooldown': 60}
+        try:
+            autoscaler = runner.Autoscaler(self.topic)
+            self.assertEqual(2, autoscaler.workers)
+            # 2 workers at 10 jobs/s each would take 50s to clear 1000 jobs; 10 clear it in the 10s allowed
+            self.assertEqual(10, autoscaler.decide(backlog=1000, rate=20, now=100))
+            self.assertEqual(3, autoscaler.decide(backlog=300, rate=20, now=100))
+            # a backlog that is not moving doubles the pool, up to max_workers
+            self.assertEqual(4, autoscaler.decide(backlog=5, rate=0, now=100))
+            autoscaler.workers = 8
+            self.assertEqual(10, autoscaler.decide(backlog=5, rate=0, now=100))
+
+            # between the thresholds, nothing changes; below them, one worker goes, once the cooldown is up
+            self.assertEqual(8, autoscaler.decide(backlog=100, rate=20, now=100))
+            autoscaler.changed = 50
+            self.assertEqual(8, autoscaler.decide(backlog=0, rate=0, now=100))
+            self.assertEqual(7, autoscaler.decide(backlog=0, rate=0, now=110))
+            autoscaler.workers = 1
+            self.assertEqual(1, autoscaler.decide(backlog=0, rate=0, now=110))
+        finally:
+            config.topics(self.topic).pop('autoscale')
+
+    def test_autoscale_sample(self):
+        config.topics(self.topic)['autoscale'] = {'max_workers': 4, 'interval': 5}
+        submitted, metrics = '%s.%s' % (self.topic, 'submitted'), '%s.%s' % (self.topic, 'metrics')
+        self.redis.delete(submitted, metrics, '%s.%s' % (self.topic, 'autoscale'))
+        try:
+            autoscaler = runner.Autoscaler(self.topic)
+            self.redis.hset(metrics, 'processed', 100)
+            self.assertEqual(2, autoscaler.sample(1000))
+
+            # 50 jobs/s with 2000 waiting is 40s of backlog; 8 workers would be needed, but 4 is the most allowed
+            self.redis.hset(metrics, 'processed', 350)
+            self.redis.rpush(submitted, *range(2000))
+            self.assertEqual(2, autoscaler.sample(1004))
+            self.assertEqual(4, autoscaler.sample(1005))
+
+            decision = json.loads(self.redis.hget('%s.%s' % (self.topic, 'autoscale'), autoscaler.id))
+            self.assertEqual('scale_up', decision['action'])
+            self.assertEqual(4, decision['workers'])
+            self.assertEqual(2000, decision['backlog'])
+            self.assertEqual('1', self.redis.hget(metrics, 'scale_up'))
+        finally:
+            config.topics(self.topic).pop('autoscale')
+            self.redis.delete(submitted, metrics, '%s.%s' % (self.topic, 'autoscale'))
+
+if __name__ == '__main__':
+    unittest.main()
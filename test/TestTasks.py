@@ -2,6 +2,8 @@ import ast
 import json
 import random
 import string
+import threading
+import time
 import unittest
 from multiprocessing import Process
 
@@ -11,6 +13,7 @@ from pyrowire import pyrowire
 import pyrowire.config.configuration as config
 from pyrowire.decorators.decorators import handler
 import pyrowire.messaging.send as sms
+import pyrowire.queues.queues as queues
 import pyrowire.runner.runner as runner
 import pyrowire.tasks.tasks as tasks
 from test import test_settings
@@ -29,6 +32,11 @@ def my_processor(message_data):
 
     return message_data
 
+def echo_handler(message_data):
+    # a handler that does not depend on which module registered the topic's handler last
+    message_data['reply'] = message_data['message']
+    return message_data
+
 class TestTasks(unittest.TestCase):
 
     def setUp(self):
@@ -47,6 +55,9 @@ class TestTasks(unittest.TestCase):
         self.redis.delete('%s.submitted' % self.topic)
         self.redis.delete('%s.pending' % self.topic)
         self.redis.delete('%s.completed' % self.topic)
+        self.redis.delete('%s.workers' % self.topic)
+        for key in self.redis.keys('%s.processing.*' % self.topic):
+            self.redis.delete(key)
 
     def test_sample_task(self):
         # queue task
@@ -85,6 +96,205 @@ class TestTasks(unittest.TestCase):
         self.assertTrue('final_data' in complete)
         self.assertEqual(complete['final_data'], complete['message'])
 
+    def test_processing_list(self):
+        sid = ''.join(random.choice(string.ascii_letters) for i in range(34))
+        message = {'message': 'You are strong in the ways of the Force.', 'number': '+1234567890',
+                   'sid': sid, 'topic': 'sample'}
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        tasks.process_queue_item(self.topic, persist=False)
+
+        # the job went through this worker's processing list, and is gone from it once handled
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+        self.assertEqual(0, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+        self.assertTrue(self.redis.hexists('%s.%s' % (self.topic, 'workers'), queues.worker_id()))
+
+    def test_batch(self):
+        settings = config.topics(self.topic)
+        handler = settings['handler']
+        settings['handler'], settings['batch_size'] = echo_handler, 3
+        sids = [''.join(random.choice(string.ascii_letters) for i in range(34)) for j in range(5)]
+        for sid in sids:
+            message = {'message': 'You are strong in the ways of the Force.', 'number': '+1234567890',
+                       'sid': sid, 'topic': 'sample'}
+            self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        try:
+            # a backlog is taken a batch at a time, in queue order
+            self.assertEqual(sids[2], tasks.process_queue_item(self.topic, persist=False))
+            self.assertEqual(2, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+            self.assertEqual(sids[4], tasks.process_queue_item(self.topic, persist=False))
+        finally:
+            settings['handler'] = handler
+            settings.pop('batch_size')
+
+        for sid in sids:
+            self.assertTrue(self.redis.hexists('%s.%s' % (self.topic, 'complete'), sid))
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+
+    def test_failed_job(self):
+        # a job missing its sid is logged to the topic's errors and dropped from the processing list in the same
+        # transaction as it would have been completed in
+        self.redis.delete('%s.%s' % (self.topic, 'errors'))
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps({'message': 'No sid', 'topic': 'sample'}))
+        tasks.process_queue_item(self.topic, persist=False)
+
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+        self.assertEqual(1, self.redis.xlen('%s.%s' % (self.topic, 'errors')))
+        self.redis.delete('%s.%s' % (self.topic, 'errors'), '%s.%s' % (self.topic, 'error.counts'))
+
+    def test_handler_error(self):
+        # any error the handler raises fails the job, rather than the worker
+        settings = config.topics(self.topic)
+
+        def failing_handler(message_data):
+            raise ValueError('cannot handle %s' % message_data['sid'])
+
+        self.redis.delete('%s.%s' % (self.topic, 'errors'))
+        message = {'message': 'Poison', 'number': '+1234567890', 'sid': 'poison', 'topic': 'sample'}
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        handler = settings['handler']
+        settings['handler'] = failing_handler
+        try:
+            self.assertIsNone(tasks.process_queue_item(self.topic, persist=False))
+        finally:
+            settings['handler'] = handler
+
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+        self.assertEqual(0, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+        self.assertEqual(1, self.redis.xlen('%s.%s' % (self.topic, 'errors')))
+        self.redis.delete('%s.%s' % (self.topic, 'errors'), '%s.%s' % (self.topic, 'error.counts'))
+
+    def test_heartbeat(self):
+        # a worker busy with a slow job keeps sending heartbeats, so its peers do not take it for dead
+        settings = config.topics(self.topic)
+        workers = '%s.%s' % (self.topic, 'workers')
+        seen = []
+
+        def slow_handler(message_data):
+            seen.append(float(self.redis.hget(workers, queues.worker_id())))
+            time.sleep(0.3)
+            seen.append(float(self.redis.hget(workers, queues.worker_id())))
+            return message_data
+
+        message = {'message': 'Slow', 'number': '+1234567890', 'sid': 'slow', 'topic': 'sample'}
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        handler, interval = settings['handler'], tasks.HEARTBEAT_INTERVAL
+        settings['handler'], tasks.HEARTBEAT_INTERVAL = slow_handler, 0.05
+        try:
+            self.assertEqual('slow', tasks.process_queue_item(self.topic, persist=False))
+        finally:
+            settings['handler'], tasks.HEARTBEAT_INTERVAL = handler, interval
+        self.assertGreater(seen[1] - seen[0], 0.2)
+
+    def test_concurrency(self):
+        settings = config.topics(self.topic)
+        settings['concurrency'], settings['batch_size'] = 3, 5
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def slow_handler(message_data):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return message_data
+
+        sids = [''.join(random.choice(string.ascii_letters) for i in range(34)) for j in range(3)]
+        for sid in sids:
+            message = {'message': 'You are strong in the ways of the Force.', 'number': '+1234567890',
+                       'sid': sid, 'topic': 'sample'}
+            self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        handler = settings['handler']
+        settings['handler'] = slow_handler
+        try:
+            start = time.time()
+            tasks.process_queue_item(self.topic, persist=False)
+            elapsed = time.time() - start
+        finally:
+            settings['handler'] = handler
+            settings.pop('concurrency')
+            settings.pop('batch_size')
+
+        # no more jobs were taken than there are threads, they ran side by side, and each was acknowledged once done
+        self.assertEqual(3, peak[0])
+        self.assertLess(elapsed, 0.15)
+        for sid in sids:
+            self.assertTrue(self.redis.hexists('%s.%s' % (self.topic, 'complete'), sid))
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+
+    def test_pool_record_failure(self):
+        settings = config.topics(self.topic)
+        settings['concurrency'] = 2
+        message = {'message': 'Unrecorded', 'number': '+1234567890', 'sid': 'unrecorded', 'topic': 'sample'}
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), json.dumps(message))
+        handler, complete_jobs = settings['handler'], tasks.complete_jobs
+
+        def unavailable(*args):
+            raise tasks.ConnectionError('redis went away')
+
+        settings['handler'], tasks.complete_jobs = echo_handler, unavailable
+        try:
+            tasks.process_queue_item(self.topic, persist=False)
+        finally:
+            tasks.complete_jobs = complete_jobs
+        # a job whose result redis could not take is handed back to the head of the queue, not left in flight
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+        self.assertEqual([json.dumps(message)], self.redis.lrange('%s.%s' % (self.topic, 'submitted'), 0, -1))
+
+        # a job whose result cannot be recorded at all is failed, rather than handed back to fail again
+        self.redis.delete('%s.%s' % (self.topic, 'errors'))
+        settings['handler'] = lambda message_data: object()
+        try:
+            tasks.process_queue_item(self.topic, persist=False)
+        finally:
+            settings['handler'] = handler
+            settings.pop('concurrency')
+        self.assertEqual(0, self.redis.llen(queues.processing_list(self.topic)))
+        self.assertEqual(0, self.redis.llen('%s.%s' % (self.topic, 'submitted')))
+        self.assertEqual(1, self.redis.xlen('%s.%s' % (self.topic, 'errors')))
+        self.redis.delete('%s.%s' % (self.topic, 'errors'), '%s.%s' % (self.topic, 'error.counts'))
+
+    def test_process_queues(self):
+        settings = config.topics(self.topic)
+        handler = settings['handler']
+        settings['handler'] = echo_handler
+        config.topics()['other'] = dict(settings)
+        sids = dict((topic, [''.join(random.choice(string.ascii_letters) for i in range(34)) for j in range(3)])
+                    for topic in [self.topic, 'other'])
+        for topic in sids:
+            for sid in sids[topic]:
+                message = {'message': 'You are strong in the ways of the Force.', 'number': '+1234567890',
+                           'sid': sid, 'topic': topic}
+                self.redis.rpush('%s.%s' % (topic, 'submitted'), json.dumps(message))
+        try:
+            # with a weight and concurrency of one each, a round takes one job from each topic
+            tasks.process_queues([self.topic, 'other'], persist=False)
+            for topic in sids:
+                self.assertTrue(self.redis.hexists('%s.%s' % (topic, 'complete'), sids[topic][0]))
+                self.assertEqual(2, self.redis.llen('%s.%s' % (topic, 'submitted')))
+                self.assertEqual(0, self.redis.llen(queues.processing_list(topic)))
+        finally:
+            settings['handler'] = handler
+            config.topics().pop('other')
+            self.redis.delete('other.submitted', 'other.complete', 'other.workers', 'other.metrics')
+
+    def test_reap(self):
+        workers = '%s.%s' % (self.topic, 'workers')
+        dead, alive = 'dead-host:1', 'live-host:1'
+        self.redis.hset(workers, dead, time.time() - queues.STALE_AFTER - 1)
+        self.redis.hset(workers, alive, time.time())
+        self.redis.rpush(queues.processing_list(self.topic, dead), 'first', 'second')
+        self.redis.rpush(queues.processing_list(self.topic, alive), 'third')
+        self.redis.rpush('%s.%s' % (self.topic, 'submitted'), 'fourth')
+
+        self.assertEqual(2, tasks.reap(self.topic, self.redis))
+        # the dead worker's jobs go back to the head of the queue, oldest first; the live worker's are left alone
+        self.assertEqual(['first', 'second', 'fourth'], self.redis.lrange('%s.%s' % (self.topic, 'submitted'), 0, -1))
+        self.assertEqual(['third'], self.redis.lrange(queues.processing_list(self.topic, alive), 0, -1))
+        self.assertFalse(self.redis.hexists(workers, dead))
+        self.assertTrue(self.redis.hexists(workers, alive))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import random
+import string
+import unittest
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.resources import profanity as profanity_terms
+from pyrowire.validators import automaton
+from pyrowire.validators.validators import profanity, parseable
+from test import test_settings
+
+pyro.configure(test_settings)
+
+
+class TestValidators(unittest.TestCase):
+
+    def setUp(self):
+        self.topic = 'sample'
+
+    def tearDown(self):
+        config.topics(self.topic).pop('parseable_characters', None)
+
+    def message(self, text):
+        return {'message': text, 'topic': self.topic}
+
+    def test_no_message(self):
+        self.assertRaises(TypeError, profanity, None)
+
+    def test_profanity(self):
+        self.assertTrue(profanity(self.message('What the FUCK')))
+        # spaces are removed before matching
+        self.assertTrue(profanity(self.message('f u c k')))
+        self.assertFalse(profanity(self.message('You are strong in the ways of the Force.')))
+
+    def test_every_term_matches(self):
+        for term in profanity_terms.profanity:
+            message = 'hello %s there' % term
+            # the same answer as a substring search for every term against the normalized message
+            self.assertEqual(any(t in message.replace(' ', '').lower() for t in profanity_terms.profanity),
+                             profanity(self.message(message)), term)
+
+    def test_matches_naive_search(self):
+        terms = ['he', 'she', 'his', 'hers', 'ushers', 'ass', 'bass']
+        compiled = automaton.build(terms)
+        for i in range(2000):
+            text = ''.join(random.choice('abehirsu') for j in range(random.randint(0, 12)))
+            self.assertEqual(any(t in text for t in terms), automaton.search(compiled, text), text)
+
+    def test_parseable(self):
+        self.assertFalse(parseable(self.message(u'Hello there, General Kenobi!')))
+        self.assertFalse(parseable(self.message(u'')))
+        for c in u'|\\;+\té\U0001F62C':
+            self.assertTrue(parseable(self.message(u'Hello %s' % c)), c)
+
+    def test_parseable_topic_characters(self):
+        config.topics(self.topic)['parseable_characters'] = u'éñ\U0001F62C'
+        self.assertFalse(parseable(self.message(u'Olé, mañana \U0001F62C')))
+        self.assertTrue(parseable(self.message(u'Olé | mañana')))
+
+    def test_empty_automaton(self):
+        self.assertFalse(automaton.search(automaton.build([]), string.ascii_letters))
+
+if __name__ == '__main__':
+    unittest.main()
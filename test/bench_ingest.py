@@ -0,0 +1,48 @@
+import random
+import string
+import sys
+import time
+
+from redis import Redis
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from test import test_settings
+
+pyro.configure(test_settings)
+
+TOPIC = 'sample'
+INBOUND = '/queue/%s?Body=%s&From=+1234567890&MessageSid=%s'
+
+
+def unpooled_connection():
+    """
+    the pre-pool behavior: a new client, and so a new TCP connection, for every inbound request
+    """
+    return Redis(config.redis('host'), int(config.redis('port')), int(config.redis('db')), config.redis('password'))
+
+
+def requests_per_second(client, count):
+    sids = [''.join(random.choice(string.ascii_letters) for i in range(34)) for j in range(count)]
+    start = time.time()
+    for sid in sids:
+        client.get(INBOUND % (TOPIC, 'Hello there', sid))
+    return count / (time.time() - start)
+
+
+def main(count=2000):
+    client = config.app().test_client()
+    pooled_connection = config.redis_connection
+
+    config.redis_connection = unpooled_connection
+    before = requests_per_second(client, count)
+
+    config.redis_connection = pooled_connection
+    after = requests_per_second(client, count)
+
+    pooled_connection().delete('%s.submitted' % TOPIC)
+    print('per-request client: %8.1f req/s' % before)
+    print('shared pool:        %8.1f req/s' % after)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,49 @@
+import itertools
+import random
+import timeit
+
+from pyrowire.resources import profanity as profanity_terms
+from pyrowire.validators import automaton
+
+WORDS = ('hey are you coming to the show tonight i think it starts at eight so we should grab food first '
+         'text me when you get off work and let me know what you want to do about the tickets thanks').split()
+LENGTHS = (20, 80, 160, 480, 1600)
+
+
+def takewhile_profane(message):
+    """
+    the previous implementation: one substring search per term until a match is found
+    """
+    not_in = []
+    for i in itertools.takewhile(lambda x: x not in message, profanity_terms.profanity):
+        not_in.append(i)
+    return len(not_in) != len(profanity_terms.profanity)
+
+
+def sms(length):
+    """
+    a clean message of the given length; clean messages are the worst case for both implementations, since every
+    term has to be ruled out
+    """
+    while True:
+        words = []
+        while len(' '.join(words)) < length:
+            words.append(random.choice(WORDS))
+        message = ' '.join(words)[:length].replace(' ', '').lower()
+        if not takewhile_profane(message):
+            return message
+
+
+def main(number=200):
+    compiled = automaton.build(profanity_terms.profanity)
+    print('build: %.1f ms' % (timeit.timeit(lambda: automaton.build(profanity_terms.profanity), number=5) / 5 * 1000))
+    print('%6s %14s %14s' % ('chars', 'takewhile us', 'automaton us'))
+    for length in LENGTHS:
+        message = sms(length)
+        assert not automaton.search(compiled, message)
+        before = timeit.timeit(lambda: takewhile_profane(message), number=number) / number * 1e6
+        after = timeit.timeit(lambda: automaton.search(compiled, message), number=number) / number * 1e6
+        print('%6d %14.1f %14.1f' % (length, before, after))
+
+if __name__ == '__main__':
+    main()
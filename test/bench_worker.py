@@ -0,0 +1,106 @@
+import json
+import socket
+import sys
+import time
+from multiprocessing import Process
+
+from pyrowire import pyrowire as pyro
+import pyrowire.config.configuration as config
+from pyrowire.queues.queues import BLOCK_TIMEOUT, backend, processing_list
+import pyrowire.tasks.tasks as tasks
+from test import test_settings
+
+pyro.configure(test_settings)
+
+TOPIC = 'sample'
+SUBMITTED = '%s.submitted' % TOPIC
+
+
+def handler(message_data):
+    return message_data
+
+
+def fill(redis, count):
+    pipeline = redis.pipeline(transaction=False)
+    for i in range(count):
+        pipeline.rpush(SUBMITTED, json.dumps({'message': 'Hello there', 'number': '+1234567890',
+                                              'sid': 'SM%032d' % i, 'topic': TOPIC}))
+    pipeline.execute()
+
+
+def one_at_a_time(redis, processing):
+    """
+    the previous loop: block-move one job, handle it, then remove it and record it with separate commands
+    """
+    raw_job = redis.execute_command('BLMOVE', SUBMITTED, processing, 'LEFT', 'RIGHT', BLOCK_TIMEOUT)
+    job_data = json.loads(raw_job)
+    final_job_data = handler(job_data)
+    redis.lrem(processing, 1, raw_job)
+    redis.hset('%s.complete' % TOPIC, job_data['sid'], json.dumps(final_job_data))
+    return 1
+
+
+def batched(redis, processing, batch_size):
+    completed = []
+    for job_id, raw_job in backend(TOPIC).fetch(batch_size, redis):
+        job_data = json.loads(raw_job)
+        completed.append((job_id, job_data['sid'], handler(job_data)))
+    tasks.complete_jobs(TOPIC, completed, [], redis)
+    return len(completed)
+
+
+def waiting_handler(message_data):
+    # stands in for a handler that calls out to an http api
+    time.sleep(0.01)
+    return message_data
+
+
+def concurrent(count, concurrency):
+    """
+    runs a persistent worker on a handler that waits 10ms per job, with the given number of jobs handled at once
+    """
+    redis = config.redis_connection()
+    settings = config.topics(TOPIC)
+    handler_, settings['handler'] = settings.get('handler'), waiting_handler
+    settings['concurrency'], settings['batch_size'] = concurrency, concurrency
+    fill(redis, count)
+    start = time.time()
+    worker = Process(target=tasks.process_queue_item, args=(TOPIC,))
+    worker.start()
+    while redis.hlen('%s.complete' % TOPIC) < count:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    worker.terminate()
+    worker.join()
+    settings['handler'] = handler_
+    settings.pop('concurrency')
+    settings.pop('batch_size')
+    redis.delete('%s.complete' % TOPIC, processing_list(TOPIC, '%s:%s' % (socket.gethostname(), worker.pid)))
+    return count / elapsed
+
+
+def jobs_per_second(redis, count, step):
+    fill(redis, count)
+    start = time.time()
+    done = 0
+    while done < count:
+        done += step()
+    elapsed = time.time() - start
+    redis.delete('%s.complete' % TOPIC)
+    return count / elapsed
+
+
+def main(count=20000):
+    redis = config.redis_connection()
+    processing = processing_list(TOPIC)
+    redis.delete(SUBMITTED, processing)
+
+    print('one at a time: %9.1f jobs/s' % jobs_per_second(redis, count, lambda: one_at_a_time(redis, processing)))
+    for batch_size in (1, 10, 50, 200):
+        rate = jobs_per_second(redis, count, lambda: batched(redis, processing, batch_size))
+        print('batch of %4d: %9.1f jobs/s' % (batch_size, rate))
+    for concurrency in (1, 8, 32):
+        print('10ms handler, concurrency %2d: %7.1f jobs/s' % (concurrency, concurrent(min(count, 1000), concurrency)))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,113 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import socket
+import struct
+import threading
+import time
+import urlparse
+
+# a number the stand-in turns down, as twilio does numbers that cannot receive messages
+INVALID_NUMBER = '+15005550001'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    answers posts to the messages resource the way the twilio messages api does, on keep-alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+    # answer in one write, as the api does, rather than a write per header
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.sockets.append(self.connection)
+
+    def do_POST(self):
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('content-length') or 0)))
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.getheader('authorization'), form))
+            count = len(self.server.requests)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.reset_connections:
+            # hang up on the client once the message is accepted, before it is answered
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = 1
+            with self.server.lock:
+                self.server.resets.append(self.connection)
+            return
+        with self.server.lock:
+            busy, self.server.busy = self.server.busy > 0, max(0, self.server.busy - 1)
+        if busy:
+            status, body = 429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429}
+        elif form['To'][0] == INVALID_NUMBER:
+            status, body = 400, {'code': 21211, 'message': "The 'To' number is not a valid phone number.",
+                                 'status': 400}
+        else:
+            status, body = 201, {'sid': 'SM%032x' % count, 'to': form['To'][0], 'from': form['From'][0],
+                                 'body': form.get('Body', [''])[0], 'status': 'queued'}
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        # drop the connection without saying so, as an api does when a keep-alive connection has been idle too long
+        self.close_connection = int(self.server.drop_connections)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    a local stand-in for the twilio messages api, that records the requests and connections it gets
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0, drop_connections=False, reset_connections=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = 0
+        self.sockets = []
+        self.delay = delay
+        self.drop_connections = drop_connections
+        self.reset_connections = reset_connections
+        self.resets = []
+        # the number of requests still to answer as too many, before accepting any
+        self.busy = 0
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before they are answered
+        pass
+
+    def shutdown_request(self, request):
+        # close a connection being reset outright, so it is not shut down in good order first
+        if request in self.resets:
+            request.close()
+        else:
+            HTTPServer.shutdown_request(self, request)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # end the keep-alive connections still open, so their threads finish
+        for connection in self.sockets:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass